@@ -0,0 +1,64 @@
+import numpy as np
+
+ALPHABET = '-ABCDEFGHIJKLMNOPQRSTUVWXYZ*'
+GAP = 0
+SIZE = len(ALPHABET)
+
+_INVALID = 255
+_ENCODE = np.full(256, _INVALID, dtype=np.uint8)
+for _code, _char in enumerate(ALPHABET):
+    _ENCODE[ord(_char)] = _code
+    _ENCODE[ord(_char.lower())] = _code
+_DECODE = np.frombuffer(ALPHABET.encode('ascii'), dtype=np.uint8)
+
+
+def encode(seq: str) -> np.ndarray:
+    '''
+    seq (str): sequence of residues, lowercase letters are treated as uppercase
+
+    Returns the sequence as an array of uint8 alphabet codes, GAP is the code of '-'
+    '''
+    return encode_bytes(seq.encode('ascii', errors='replace'))
+
+
+def encode_bytes(data) -> np.ndarray:
+    '''
+    data (bytes): sequence of residues as ASCII bytes (or any buffer of them)
+
+    Returns the sequence as an array of uint8 alphabet codes
+    '''
+    codes = _ENCODE[np.frombuffer(data, dtype=np.uint8)]
+    if (codes == _INVALID).any():
+        raw = np.frombuffer(data, dtype=np.uint8)[codes == _INVALID]
+        unknown = sorted({chr(char) for char in np.unique(raw)})
+        raise KeyError(f'Unknown residues: {", ".join(unknown)}')
+    return codes
+
+
+def as_codes(seq) -> np.ndarray:
+    '''
+    seq (str | np.ndarray): sequence as a string or as an array of alphabet codes
+
+    Returns the sequence as an array of uint8 alphabet codes
+    '''
+    return encode(seq) if isinstance(seq, str) else np.asarray(seq, dtype=np.uint8)
+
+
+def decode(codes: np.ndarray) -> str:
+    '''
+    codes (np.ndarray): array of alphabet codes
+
+    Returns the sequence as a string
+    '''
+    return _DECODE[codes].tobytes().decode('ascii')
+
+
+def decode_rows(codes: np.ndarray) -> list[str]:
+    '''
+    codes (np.ndarray): (N, L) matrix of alphabet codes
+
+    Returns a list of N strings
+    '''
+    length = codes.shape[1]
+    text = _DECODE[codes].tobytes().decode('ascii')
+    return [text[i:i + length] for i in range(0, len(text), length)] if length else [''] * len(codes)
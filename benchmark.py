@@ -0,0 +1,180 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import alphabet
+import metrics
+from main import run
+from parser import parse_args
+
+RESIDUES = {
+    'DNA': 'ACGT',
+    'protein': 'ACDEFGHIKLMNPQRSTVWY',
+}
+
+
+def mutate(codes, rate, residues, rng, indel_fraction=0.1):
+    '''
+    codes (np.ndarray): sequence as alphabet codes
+    rate (float): expected number of events per position
+    residues (np.ndarray): alphabet codes of the residues to draw from
+    rng (np.random.Generator): random generator
+    indel_fraction (float): fraction of the events that are insertions or deletions
+
+    Returns a copy of the sequence with substitutions, single-residue insertions and deletions
+    '''
+    events = rng.random(len(codes)) < rate
+    kinds = rng.random(len(codes))
+    substituted = events & (kinds >= indel_fraction)
+    deleted = events & (kinds < indel_fraction / 2)
+    inserted = events & (kinds >= indel_fraction / 2) & (kinds < indel_fraction)
+
+    codes = codes.copy()
+    codes[substituted] = rng.choice(residues, substituted.sum())
+    positions = np.flatnonzero(inserted)
+    codes = np.insert(codes, positions, rng.choice(residues, len(positions)))
+    keep = np.ones(len(codes), dtype=bool)
+    keep[np.flatnonzero(deleted) + np.searchsorted(positions, np.flatnonzero(deleted), side='right')] = False
+
+    return codes[keep]
+
+
+def simulate_family(n, length, divergence, molecule='DNA', indel_fraction=0.1, seed=0):
+    '''
+    n (int): number of sequences
+    length (int): length of the ancestral sequence
+    divergence (float): expected number of events per position from the root to a leaf
+    molecule {DNA, protein}: alphabet of the sequences
+    indel_fraction (float): fraction of the events that are insertions or deletions
+    seed (int): seed of the random generator
+
+    Simulates a family evolving along a random tree: sequences are duplicated one at a time,
+    each copy of a randomly chosen member mutates along a branch of divergence / log2(n) events
+    per position
+
+    Returns a list of (name, sequence) pairs
+    '''
+    rng = np.random.default_rng(seed)
+    residues = alphabet.encode(RESIDUES[molecule])
+    rate = divergence / max(np.log2(n), 1)
+
+    family = [rng.choice(residues, length).astype(np.uint8)]
+    while len(family) < n:
+        parent = int(rng.integers(len(family)))
+        family[parent], child = (
+            mutate(family[parent], rate, residues, rng, indel_fraction),
+            mutate(family[parent], rate, residues, rng, indel_fraction),
+        )
+        family.append(child)
+
+    return [(f'seq{k}', alphabet.decode(codes)) for k, codes in enumerate(family)]
+
+
+def write_fasta(records, f):
+    with open(f, 'w', encoding='utf-8') as file:
+        file.write(''.join(f'>{name}\n{seq}\n' for name, seq in records))
+
+
+def run_pipeline(f, molecule='DNA', distance='nw', tree='upgma', threads=1, options=()):
+    '''
+    f (str): FASTA file with the sequences
+    molecule {DNA, protein}: type of the sequences
+    distance {nw, ktuple}: distances for the guide tree
+    tree {upgma, nj}: method for building the guide tree
+    threads (int): number of processes
+    options (list): further command line options of the main program
+
+    Runs the program with 'main.run' on the file and reads the measurements of its stages
+    from 'metrics'
+
+    Returns a dict of the stages with wall-clock seconds and the peak RSS after the stage,
+    and the DP cells per second of the distance matrix and of the progressive alignment
+    '''
+    metrics.reset()
+    with tempfile.TemporaryDirectory() as directory:
+        aligned = run(parse_args([
+            '-f', f, '-a', 'unaligned', '-m', molecule, '--distance', distance, '--tree', tree,
+            '--threads', str(threads), '-o', os.path.join(directory, 'out.aln'), *options,
+        ]))
+
+    stages = {name: dict(stage) for name, stage in metrics.stages.items()}
+    cells = {name: stages[name]['counters'].get('dp_cells', 0) for name in ('distance', 'align') if name in stages}
+
+    return {
+        'stages': stages,
+        'cells_per_second': {name: stages[name]['cells_per_second'] for name in cells},
+        'cells': cells,
+        'alignment_length': int(aligned.shape[1]),
+        'peak_rss_mb': metrics.peak_rss_mb(),
+    }
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the alignment pipeline on synthetic sequence families, "
+                                     "other options (e.g. --memmap-dir, --band) are passed on to the main program")
+
+    parser.add_argument("-n", "--sequences", type=int, nargs="+", default=[20, 40, 80],
+                        help="Numbers of sequences (one run for each)")
+    parser.add_argument("-l", "--length", type=int, nargs="+", default=[200], help="Lengths of the ancestral sequence")
+    parser.add_argument("-d", "--divergence", type=float, default=0.3,
+                        help="Expected number of events per position from the root to a leaf")
+    parser.add_argument("--indels", type=float, default=0.1, help="Fraction of the events that are indels")
+    parser.add_argument("-m", "--molecule", type=str, choices=("DNA", "protein"), default="DNA",
+                        help="Type of the sequences: {DNA, protein}")
+    parser.add_argument("--distance", type=str, choices=("nw", "ktuple"), default="nw",
+                        help="Distances for the guide tree: {nw, ktuple}")
+    parser.add_argument("--tree", type=str, choices=("upgma", "nj"), default="upgma",
+                        help="Method for building the guide tree: {upgma, nj}")
+    parser.add_argument("--threads", type=int, default=1, help="Number of processes")
+    parser.add_argument("--repeats", type=int, default=1, help="Number of runs of every configuration")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sequence generator")
+    parser.add_argument("-o", "--output", type=str, default=None, help="File for writing the JSON report")
+    return parser
+
+
+def main(argv=None):
+    args, options = create_parser().parse_known_args(sys.argv[1:] if argv is None else argv)
+
+    runs = []
+    with tempfile.TemporaryDirectory() as directory:
+        for n in args.sequences:
+            for length in args.length:
+                f = os.path.join(directory, f'family_{n}_{length}.fasta')
+                write_fasta(simulate_family(n, length, args.divergence, args.molecule, args.indels, args.seed), f)
+                for repeat in range(args.repeats):
+                    # a fresh process for every run, the peak RSS is a high-water mark of the process
+                    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                        result = pool.submit(
+                            run_pipeline, f, args.molecule, args.distance, args.tree, args.threads, options,
+                        ).result()
+                    runs.append({'n': n, 'length': length, 'repeat': repeat, **result})
+                    print(f"n={n} length={length} repeat={repeat}: "
+                          f"{sum(stage['seconds'] for stage in result['stages'].values()):.2f} s", file=sys.stderr)
+
+    report = {
+        'config': {**vars(args), 'options': options},
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'runs': runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import alphabet
+from condensed_matrix import CondensedMatrix
+from upgma import UPGMA_Node, postorder
+
+_MANIFEST = 'checkpoint.json'
+_DISTANCES = 'distances.npy'
+_TREE = 'tree.npz'
+_PROFILE = 'profile_{}.npz'
+_TEMPORARY = '.tmp-'
+
+
+def _atomic_write(path, write):
+    '''
+    path (str): file to write
+    write (callable): function writing the content to a binary file object
+
+    Writes a temporary file in the same directory, syncs it to disk and renames it
+    over path, so a crash leaves either the old file or the new one
+    '''
+    directory = os.path.dirname(path) or '.'
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix=_TEMPORARY)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _tree_arrays(root: UPGMA_Node) -> dict:
+    '''
+    Returns the tree as arrays in post-order: leaf ids (-1 for internal nodes), numbers
+    of children, heights and the branch lengths of all internal nodes one after another
+    '''
+    nodes = list(postorder(root))
+    return {
+        'ids': np.array([-1 if node.children else node.id for node in nodes], dtype=np.int64),
+        'arity': np.array([len(node.children) for node in nodes], dtype=np.int64),
+        'heights': np.array([node.height for node in nodes], dtype=np.float64),
+        'branch_lengths': np.array([length for node in nodes for length in node.branch_lengths], dtype=np.float64),
+    }
+
+
+def _tree_from_arrays(ids, arity, heights, branch_lengths) -> UPGMA_Node:
+    stack = []
+    offset = 0
+    for id, n, height in zip(ids.tolist(), arity.tolist(), heights.tolist()):
+        if n == 0:
+            stack.append(UPGMA_Node(id=id, height=height))
+            continue
+        children = stack[len(stack) - n:]
+        del stack[len(stack) - n:]
+        stack.append(UPGMA_Node(
+            children=children,
+            height=height,
+            branch_lengths=branch_lengths[offset:offset + n].tolist(),
+        ))
+        offset += n
+
+    return stack[0]
+
+
+class Checkpoint:
+    """
+    Directory with the intermediate results of a run: the condensed distance matrix (.npy),
+    the guide tree and the profiles of aligned subtrees (.npz), each file written atomically.
+
+    The run is identified by a fingerprint of the sequences and the parameters; a checkpoint
+    is only resumed by a run with the same fingerprint. Subtree profiles are saved at most
+    every 'interval' seconds, and a saved profile replaces the saved profiles below it.
+    """
+
+    def __init__(self, directory, fingerprint, resume=False, interval=60.0):
+        '''
+        directory (str): checkpoint directory, created if missing
+        fingerprint (str): fingerprint of the run, see 'Checkpoint.fingerprint'
+        resume (bool): whether to keep the results of an earlier run, otherwise they are removed
+        interval (float): minimal number of seconds between two saved subtree profiles
+        '''
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.interval = interval
+        self.saved = time.perf_counter()
+
+        manifest = self._path(_MANIFEST)
+        if resume and os.path.exists(manifest):
+            with open(manifest, encoding='utf-8') as file:
+                if json.load(file)['fingerprint'] != fingerprint:
+                    raise ValueError(f'Checkpoint in {directory} belongs to a run with other sequences or parameters')
+            self._remove(_TEMPORARY + '*')
+        else:
+            self._remove(_TEMPORARY + '*', _DISTANCES, _TREE, _PROFILE.format('*'), _MANIFEST)
+            text = json.dumps({'fingerprint': fingerprint}).encode('utf-8')
+            _atomic_write(manifest, lambda file: file.write(text))
+
+    @staticmethod
+    def fingerprint(sequences, params) -> str:
+        '''
+        sequences (list): sequences of the run (strings or arrays of alphabet codes)
+        params (tuple): parameters the results depend on
+
+        Returns the fingerprint of the run as a hex string
+        '''
+        digest = hashlib.blake2b(repr(params).encode('utf-8'), digest_size=16)
+        for seq in sequences:
+            codes = alphabet.as_codes(seq).tobytes()
+            digest.update(len(codes).to_bytes(8, 'little'))
+            digest.update(codes)
+        return digest.hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _remove(self, *patterns):
+        for pattern in patterns:
+            for path in glob.glob(self._path(pattern)):
+                os.remove(path)
+
+    def _save(self, name, **arrays):
+        _atomic_write(self._path(name), lambda file: np.savez(file, **arrays))
+
+    def _load(self, name):
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+
+    def save_distances(self, dist_matrix: CondensedMatrix):
+        _atomic_write(self._path(_DISTANCES), lambda file: np.save(file, dist_matrix.data))
+
+    def load_distances(self, directory=None):
+        '''
+        directory (str): directory for the memory-mapped matrix, see 'CondensedMatrix'
+
+        Returns the saved distance matrix as a CondensedMatrix or None. The file is
+        memory-mapped and copied in chunks, so it is never read into memory at once
+        '''
+        path = self._path(_DISTANCES)
+        if not os.path.exists(path):
+            return None
+        data = np.load(path, mmap_mode='r')
+        return CondensedMatrix.from_data(data, data.dtype, directory)
+
+    def save_tree(self, root: UPGMA_Node):
+        self._save(_TREE, **_tree_arrays(root))
+
+    def load_tree(self):
+        '''
+        Returns the root of the saved guide tree or None
+        '''
+        data = self._load(_TREE)
+        return None if data is None else _tree_from_arrays(**data)
+
+    def due(self) -> bool:
+        '''
+        Returns whether 'interval' seconds have passed since the last saved profile
+        '''
+        return time.perf_counter() - self.saved >= self.interval
+
+    def save_profile(self, k, codes, replaces=()):
+        '''
+        k (int): post-order index of the subtree in the guide tree
+        codes (np.ndarray): aligned subtree as a matrix of alphabet codes
+        replaces (iterable): indices of saved profiles inside the subtree, removed after saving
+        '''
+        self._save(_PROFILE.format(k), codes=codes)
+        self.saved = time.perf_counter()
+        for child in replaces:
+            self.remove_profile(child)
+
+    def load_profile(self, k):
+        data = self._load(_PROFILE.format(k))
+        if data is None or 'codes' not in data:
+            raise ValueError(f'Checkpoint in {self.directory} has no valid profile {k}')
+        return data['codes']
+
+    def remove_profile(self, k):
+        self._remove(_PROFILE.format(k))
+
+    def profiles(self) -> set:
+        '''
+        Returns the post-order indices of the saved subtree profiles
+        '''
+        names = glob.glob(self._path(_PROFILE.format('*')))
+        return {int(os.path.basename(name)[len('profile_'):-len('.npz')]) for name in names}
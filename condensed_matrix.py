@@ -0,0 +1,114 @@
+import math
+import tempfile
+
+import numpy as np
+
+# number of entries copied at once between stores
+_CHUNK = 1 << 24
+
+
+class CondensedMatrix:
+    """
+    Symmetric matrix with a zero diagonal kept as its upper triangle: entry (i, j), i < j,
+    is at data[i * n - i * (i + 1) / 2 + j - i - 1], the order of scipy's condensed matrices.
+
+    The entries take n * (n - 1) / 2 values of 'dtype' (float32 by default) in memory or,
+    with 'directory', in a memory-mapped temporary file there that is removed when the
+    matrix is released, so matrices larger than the memory are paged from the disk.
+    """
+
+    def __init__(self, n, dtype=np.float32, directory=None):
+        '''
+        n (int): number of rows
+        dtype (np.dtype): type of the entries
+        directory (str): directory for the memory-mapped file, None to keep the entries in memory
+        '''
+        self.n = n
+        size = n * (n - 1) // 2
+        if directory is None or size == 0:
+            self.file = None
+            self.data = np.zeros(size, dtype=dtype)
+        else:
+            self.file = tempfile.TemporaryFile(dir=directory)
+            self.data = np.memmap(self.file, dtype=dtype, mode='w+', shape=(size,))
+        # offsets[i] + j is the position of entry (i, j) for i < j
+        rows = np.arange(n, dtype=np.int64)
+        self.offsets = rows * n - rows * (rows + 1) // 2 - rows - 1
+
+    @classmethod
+    def from_data(cls, data, dtype=np.float32, directory=None):
+        '''
+        data (np.ndarray): condensed entries (e.g. a memory-mapped .npy file), copied in chunks
+
+        Returns the CondensedMatrix of the entries
+        '''
+        condensed = cls((1 + math.isqrt(1 + 8 * len(data))) // 2, dtype, directory)
+        for start in range(0, len(data), _CHUNK):
+            condensed.data[start:start + _CHUNK] = data[start:start + _CHUNK]
+        return condensed
+
+    @classmethod
+    def from_dense(cls, matrix, dtype=np.float32, directory=None):
+        '''
+        matrix (np.ndarray): symmetric (N, N) matrix
+
+        Returns the upper triangle of the matrix as a CondensedMatrix
+        '''
+        matrix = np.asarray(matrix)
+        condensed = cls(len(matrix), dtype, directory)
+        for i in range(len(matrix) - 1):
+            condensed.data[condensed.offsets[i] + i + 1:condensed.offsets[i] + len(matrix)] = matrix[i, i + 1:]
+        return condensed
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        i, j = sorted(index)
+        return 0.0 if i == j else float(self.data[self.offsets[i] + j])
+
+    def __setitem__(self, index, value):
+        i, j = sorted(index)
+        self.data[self.offsets[i] + j] = value
+
+    def segment(self, i) -> np.ndarray:
+        '''
+        Returns the entries (i, j) for j > i, a view of the data
+        '''
+        return self.data[self.offsets[i] + i + 1:self.offsets[i] + self.n]
+
+    def row(self, i) -> np.ndarray:
+        '''
+        Returns row i as a float64 array (gathered from column i above the diagonal
+        and the segment of row i to the right of it)
+        '''
+        row = np.empty(self.n, dtype=np.float64)
+        row[:i] = self.data[self.offsets[:i] + i]
+        row[i] = 0.0
+        row[i + 1:] = self.segment(i)
+        return row
+
+    def set_row(self, i, values):
+        '''
+        values (np.ndarray): new row i, its diagonal entry is ignored
+        '''
+        self.data[self.offsets[:i] + i] = values[:i]
+        self.data[self.offsets[i] + i + 1:self.offsets[i] + self.n] = values[i + 1:]
+
+    def to_dense(self, dtype=np.float64) -> np.ndarray:
+        '''
+        Returns the full symmetric (N, N) matrix
+        '''
+        dense = np.zeros((self.n, self.n), dtype=dtype)
+        for i in range(self.n - 1):
+            dense[i, i + 1:] = self.segment(i)
+        return dense + dense.T
+
+    def close(self):
+        '''
+        Releases the memory-mapped file
+        '''
+        if self.file is not None:
+            self.data = None
+            self.file.close()
+            self.file = None
@@ -0,0 +1,82 @@
+import numpy as np
+
+from alphabet import GAP, as_codes
+
+
+def _merge_similar(codes, groups, identity):
+    '''
+    Merges the groups whose representatives have the same length and at least 'identity'
+    identical positions with the representative of an earlier group
+    '''
+    by_length = {}
+    for g, group in enumerate(groups):
+        by_length.setdefault(len(codes[group[0]]), []).append(g)
+
+    merged = {}
+    for length, members in by_length.items():
+        centers = np.empty((len(members), length), dtype=np.uint8)
+        center_groups = []
+        for g in members:
+            seq = codes[groups[g][0]]
+            if center_groups:
+                same = (centers[:len(center_groups)] == seq).sum(axis=1)
+                best = int(same.argmax())
+                if same[best] >= identity * length:
+                    merged[center_groups[best]].extend(groups[g])
+                    continue
+            centers[len(center_groups)] = seq
+            center_groups.append(g)
+            merged[g] = list(groups[g])
+
+    return [merged[g] for g in sorted(merged)]
+
+
+def collapse(sequences, identity=1.0):
+    '''
+    sequences (list): sequences (strings or arrays of alphabet codes)
+    identity (float): minimal fraction of identical positions of a sequence and the
+                      representative of its group, 1.0 collapses exact duplicates only
+
+    Groups exact duplicates by a hash of their codes. Below 1.0, the groups are then merged
+    into the group of the first earlier representative of the same length with the most
+    identical positions if it reaches the identity: members differ from their representative
+    by substitutions only, so they can be placed into the columns of its aligned row
+
+    Returns the indices of the representatives (the first sequence of every group, in input
+    order) and the lists of the indices of the members of every group, representative first
+    '''
+    codes = [as_codes(seq) for seq in sequences]
+    first = {}
+    groups = []
+    for k, seq in enumerate(codes):
+        key = seq.tobytes()
+        if key in first:
+            groups[first[key]].append(k)
+        else:
+            first[key] = len(groups)
+            groups.append([k])
+
+    if identity < 1.0:
+        groups = _merge_similar(codes, groups, identity)
+
+    return [group[0] for group in groups], groups
+
+
+def expand(aligned, rows, sequences, groups):
+    '''
+    aligned (np.ndarray): (R, L) matrix of alphabet codes of the aligned representatives
+    rows (list): group of every row of aligned
+    sequences (list): all sequences passed to 'collapse'
+    groups (list): groups returned by 'collapse'
+
+    Returns the (N, L) alignment with every representative row replaced by the rows of its
+    group (the residues of every member in the columns of the representative), and the
+    indices of the sequences of the rows
+    '''
+    order = [k for row in rows for k in groups[row]]
+    expanded = np.repeat(aligned, [len(groups[row]) for row in rows], axis=0)
+    residues = expanded != GAP
+    if len(order):
+        expanded[residues] = np.concatenate([as_codes(sequences[k]) for k in order])
+
+    return expanded, order
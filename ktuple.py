@@ -0,0 +1,237 @@
+import numpy as np
+
+import alphabet
+
+# bound on the entries of the temporary arrays of a block of rows of the shared k-tuple counts
+BLOCK_CELLS = 1 << 22
+# measured cost of a scattered update of the sparse product relative to a multiply-add
+# of the dense one, used to choose between the two
+SPARSE_COST = 500
+
+# k-tuple ids are exact polynomials while base ** k stays below this bound
+_EXACT_IDS = 1 << 62
+
+
+def _mix(ids: np.ndarray) -> np.ndarray:
+    '''
+    SplitMix64 finalizer of uint64 values (multiplications wrap around)
+    '''
+    ids = ids ^ (ids >> np.uint64(30))
+    ids = ids * np.uint64(0xBF58476D1CE4E5B9)
+    ids = ids ^ (ids >> np.uint64(27))
+    ids = ids * np.uint64(0x94D049BB133111EB)
+    return ids ^ (ids >> np.uint64(31))
+
+
+def kmer_ids(codes: np.ndarray, k: int, residues: np.ndarray) -> np.ndarray:
+    '''
+    codes (np.ndarray): sequence as alphabet codes
+    k (int): length of k-tuples
+    residues (np.ndarray): map from alphabet code to a dense residue index, -1 for gaps
+
+    Returns integer ids of all k-tuples of the sequence (k-tuples with gaps are skipped).
+    The ids are the k-tuples as numbers in base 'number of residues' while they fit into
+    62 bits, longer k-tuples are hashed with a 64-bit mix (collisions are negligible)
+    '''
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    index = residues[codes].astype(np.int64)
+    base = int(residues.max()) + 1
+    exact = base ** k < _EXACT_IDS
+    ids = np.zeros(n, dtype=np.int64 if exact else np.uint64)
+    valid = np.ones(n, dtype=bool)
+    for shift in range(k):
+        window = index[shift:shift + n]
+        if exact:
+            ids = ids * base + window
+        else:
+            ids = _mix(ids ^ (window + 1).astype(np.uint64))
+        valid &= window >= 0
+
+    return ids[valid].view(np.int64)
+
+
+class KmerCounts:
+    """
+    Sparse (N, U) matrix of k-tuple counts in compressed row form: the counts of row i are
+    counts[indptr[i]:indptr[i + 1]] in the columns columns[indptr[i]:indptr[i + 1]]
+    """
+
+    def __init__(self, indptr: np.ndarray, columns: np.ndarray, counts: np.ndarray, n_columns: int):
+        self.indptr = indptr
+        self.columns = columns
+        self.counts = counts
+        self.n_columns = n_columns
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.indptr) - 1
+
+    def dense(self, rows: range) -> np.ndarray:
+        '''
+        Returns the (len(rows), U) dense block of the given rows
+        '''
+        lo, hi = self.indptr[rows.start], self.indptr[rows.stop]
+        block = np.zeros((len(rows), self.n_columns), dtype=self.counts.dtype)
+        entry_rows = np.repeat(np.arange(len(rows)), np.diff(self.indptr[rows.start:rows.stop + 1]))
+        block[entry_rows, self.columns[lo:hi]] = self.counts[lo:hi]
+        return block
+
+    def transpose(self) -> "KmerCounts":
+        '''
+        Returns the (U, N) transposed matrix, the lists of the sequences every k-tuple occurs in
+        '''
+        rows = np.repeat(np.arange(self.n_rows, dtype=self.columns.dtype), np.diff(self.indptr))
+        order = np.argsort(self.columns, kind='stable')
+        indptr = np.zeros(self.n_columns + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.columns, minlength=self.n_columns), out=indptr[1:])
+        return KmerCounts(indptr, rows[order], self.counts[order], self.n_rows)
+
+
+def kmer_counts(sequences, k):
+    '''
+    sequences (list): list of sequences (str or arrays of alphabet codes)
+    k (int): length of k-tuples
+
+    Returns sparse (N, U) k-tuple counts over the U k-tuples present in the input (KmerCounts),
+    and the number of k-tuples in every sequence
+    '''
+    encoded = [alphabet.as_codes(seq) for seq in sequences]
+
+    present = np.zeros(alphabet.SIZE, dtype=bool)
+    for codes in encoded:
+        present[codes] = True
+    present[alphabet.GAP] = False
+    residues = np.where(present, np.cumsum(present) - 1, -1)
+
+    ids = [kmer_ids(codes, k, residues) for codes in encoded]
+    lengths = np.array([len(seq_ids) for seq_ids in ids], dtype=np.int64)
+    _, inverse = np.unique(np.concatenate(ids) if ids else np.empty(0, np.int64), return_inverse=True)
+    n_columns = int(inverse.max()) + 1 if len(inverse) else 0
+
+    # (row, column) entries sorted by row, then by column
+    rows = np.repeat(np.arange(len(ids), dtype=np.int64), lengths)
+    entries, counts = np.unique(rows * n_columns + inverse.ravel(), return_counts=True)
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(entries // max(n_columns, 1), minlength=len(ids)), out=indptr[1:])
+    columns = (entries % max(n_columns, 1)).astype(np.int32)
+
+    return KmerCounts(indptr, columns, counts.astype(np.int32), n_columns), lengths
+
+
+def _shared_sparse(counts: KmerCounts, postings: KmerCounts, rows: range) -> np.ndarray:
+    '''
+    Returns the shared counts of the rows with all sequences, summed over the
+    sequences every k-tuple of the rows occurs in
+    '''
+    n = counts.n_rows
+    lo, hi = counts.indptr[rows.start], counts.indptr[rows.stop]
+    entry_rows = np.repeat(np.arange(len(rows)), np.diff(counts.indptr[rows.start:rows.stop + 1]))
+    columns, entry_counts = counts.columns[lo:hi], counts.counts[lo:hi]
+
+    sizes = np.diff(postings.indptr)[columns]
+    offsets = np.cumsum(sizes) - sizes
+    positions = np.repeat(postings.indptr[columns] - offsets, sizes) + np.arange(sizes.sum())
+    shared = np.bincount(
+        np.repeat(entry_rows, sizes) * n + postings.columns[positions],
+        weights=np.minimum(np.repeat(entry_counts, sizes), postings.counts[positions]),
+        minlength=len(rows) * n,
+    )
+    return shared.reshape(len(rows), n)
+
+
+def _shared_dense(counts: KmerCounts, rows: range) -> np.ndarray:
+    '''
+    Returns the shared counts of the rows with all sequences as sums of dot products
+    of dense blocks of the indicator matrices (counts >= t), t = 1, 2, ...
+    '''
+    n = counts.n_rows
+    step = max(BLOCK_CELLS // max(counts.n_columns, 1), 1)
+    block = counts.dense(rows)
+    shared = np.zeros((len(rows), n))
+    for start in range(0, n, step):
+        other = counts.dense(range(start, min(start + step, n)))
+        threshold = 1
+        while True:
+            keep = (block >= threshold).any(axis=0) & (other >= threshold).any(axis=0)
+            if not keep.any():
+                break
+            first = (block[:, keep] >= threshold).astype(np.float32)
+            second = (other[:, keep] >= threshold).astype(np.float32)
+            shared[:, start:start + len(other)] += first @ second.T
+            threshold += 1
+
+    return shared
+
+
+def _row_blocks(costs, limit):
+    '''
+    Returns consecutive ranges of rows with a total cost of at most limit (at least one row each)
+    '''
+    blocks = []
+    start, total = 0, 0
+    for row, cost in enumerate(costs.tolist()):
+        if row > start and total + cost > limit:
+            blocks.append(range(start, row))
+            start, total = row, 0
+        total += cost
+    if start < len(costs):
+        blocks.append(range(start, len(costs)))
+    return blocks
+
+
+def shared_kmers(counts: KmerCounts):
+    '''
+    counts (KmerCounts): sparse (N, U) k-tuple counts
+
+    Yields blocks of rows and the (R, N) matrices of their shared k-tuple counts
+    sum_u min(counts[i, u], counts[j, u]). Sparse inputs are summed over the lists of the
+    sequences every k-tuple occurs in, at the cost of sum_u df_u^2 updates (df_u sequences
+    contain k-tuple u); dense inputs (short k-tuples) as dot products of dense indicator
+    blocks, whichever is estimated to be cheaper
+    '''
+    n = counts.n_rows
+    postings = counts.transpose()
+    df = np.diff(postings.indptr).astype(np.float64)
+    column_max = np.maximum.reduceat(postings.counts, postings.indptr[:-1]) if counts.n_columns else np.zeros(0)
+
+    if SPARSE_COST * (df ** 2).sum() < float(n) * n * column_max.sum():
+        # every row costs its share of the result and the postings of its k-tuples
+        expansion = np.bincount(np.repeat(np.arange(n), np.diff(counts.indptr)), weights=df[counts.columns], minlength=n)
+        for rows in _row_blocks(expansion + n, BLOCK_CELLS):
+            yield rows, _shared_sparse(counts, postings, rows)
+    else:
+        step = max(BLOCK_CELLS // max(counts.n_columns, n, 1), 1)
+        for start in range(0, n, step):
+            rows = range(start, min(start + step, n))
+            yield rows, _shared_dense(counts, rows)
+
+
+def ktuple_distance_matrix(sequences, k=2, out=None):
+    '''
+    sequences (list): list of sequences (str or arrays of alphabet codes)
+    k (int): length of k-tuples
+    out (CondensedMatrix): matrix the distances are written to, a dense matrix is allocated if None
+
+    Returns pairwise distance matrix 1 - shared / min(n_i, n_j), where shared is the number of
+    k-tuples the two sequences have in common and n_i the number of k-tuples in sequence i
+    (out if given). The matrix is filled block by block of rows
+    '''
+    counts, lengths = kmer_counts(sequences, k)
+    n = len(lengths)
+    dist_matrix = np.zeros((n, n)) if out is None else out
+
+    for rows, shared in shared_kmers(counts):
+        shortest = np.minimum.outer(lengths[rows.start:rows.stop], lengths).astype(np.float64)
+        similarity = np.divide(shared, shortest, out=np.zeros_like(shared), where=shortest > 0)
+        if out is None:
+            dist_matrix[rows.start:rows.stop] = 1 - similarity
+        else:
+            for i in rows:
+                out.segment(i)[:] = 1 - similarity[i - rows.start, i + 1:]
+
+    if out is None:
+        np.fill_diagonal(dist_matrix, 0)
+    return dist_matrix
@@ -1,102 +1,184 @@
 
-import blosum as bl
-from itertools import product
+import os
+import sys
 
+import numpy as np
+
+import metrics
 from upgma import (
     create_distance_matrix,
+    leaves,
+    sequence_weights,
     upgma,
 )
+from ktuple import ktuple_distance_matrix
+from checkpoint import Checkpoint
+from condensed_matrix import CondensedMatrix
+from dedup import collapse, expand
+from neighbor_joining import neighbor_joining
 from parser import parse_args
-from progressive_alignment import progressive_alignment
-from read_write_file import read_seqs, fasta_to_clustal
-
-
-def get_weight_matrix():
-    matrix = bl.BLOSUM(62, default=0)
-    acids = [acid for acid in matrix.keys() if acid != "*"]
-    
-    return {
-        **{
-            (acid1, acid2): float(matrix[acid1][acid2]) + 5
-            for acid1 in acids
-            for acid2 in acids
-        },
-        **{(acid, "-"): 0.0 for acid in acids},
-        **{("-", acid): 0.0 for acid in acids},
-        ("-", "-"): 0.0,
-    }
-
-def get_dna_matrix(match, mismatch, gap):
-    matrix ={}
-    for i, j in product(['A', 'T', 'G', 'C','-'], repeat = 2):
-        if i == '-' and j == '-':
-             matrix[(i,j)] = 0
-             continue
-        elif i == '-' or j == '-':
-            matrix[(i,j)] = -gap
-            matrix[(j,i)] = -gap
-        elif i == j:
-            matrix[(i,j)] = match
-            matrix[(j, i)] = match
-        else:
-            matrix[(i,j)] = -mismatch
-            matrix[(j,i)] = -mismatch
-    return matrix
-
-
-def get_ids_from_guide_tree(ids):
-    stack = list(ids)
-    current_number = []
-    res=[]
-    for item in stack:
-        if item.isdigit():
-            current_number.append(item)
-        else:
-            if current_number:
-                res.append(''.join(current_number))
-                current_number = []
-    
-    if current_number:
-        res.append(''.join(current_number))
-    return res
+from progressive_alignment import add_to_alignment, progressive_alignment
+from score_cache import ScoreCache
+from scoring import blosum_matrix, dna_matrix
+from read_write_file import read_seqs, read_tree, write_tree, write_alignment
 
 
-def main_():
-    args = parse_args()
+def get_ids_from_guide_tree(root):
+    return [str(id) for id in leaves(root)]
+
+
+def run(args):
+    '''
+    args (Args): parsed command line, see 'parser.parse_args'
+
+    Runs the program: reads the sequences, builds the guide tree, aligns them and writes
+    the alignment, measuring every stage with 'metrics.stage'
+
+    Returns the aligned sequences as a matrix of alphabet codes in the order of the output
+    '''
     molecule = args.molecule
     if molecule == 'DNA':
-        weight_matrix = get_dna_matrix(args.match, args.mismatch, args.gap_open)
+        weight_matrix = dna_matrix(args.match, args.mismatch, args.gap_open)
     else:
-        weight_matrix = get_weight_matrix()
-
-
-    sequences, names = read_seqs(args.filename, args.alignment_mode)
-    distances, _ = create_distance_matrix(sequences=sequences)
+        weight_matrix = blosum_matrix(62)
 
-    print('Building the tree...\n')
 
-    node = upgma(dist_matrix=distances)
-    
-    print('Aligning...\n')
+    with metrics.stage('read'):
+        if args.add is not None:
+            alignment, alignment_names = read_seqs(args.filename, 'aligned', keep_gaps=True)
+            sequences, names = read_seqs(args.add, 'unaligned')
+        else:
+            sequences, names = read_seqs(args.filename, args.alignment_mode)
+
+    if args.add is not None and len({len(seq) for seq in alignment}) > 1:
+        raise ValueError('Sequences of the existing alignment have different lengths')
+
+    checkpoint = None
+    if args.checkpoint_dir is not None:
+        params = (molecule, args.alignment_mode, args.match, args.mismatch, args.gap_open, args.gap_extension,
+                  args.distance, args.ktuple, args.tree, args.distance_dtype, args.band, args.guide_tree_in,
+                  args.add is not None, args.dedup, args.seq_weights)
+        inputs = (alignment if args.add is not None else []) + sequences
+        checkpoint = Checkpoint(args.checkpoint_dir, Checkpoint.fingerprint(inputs, params), resume=args.resume)
+
+    # duplicates are aligned once, as representatives weighted by the size of their group
+    weights = None
+    if args.dedup is not None:
+        with metrics.stage('dedup'):
+            representatives, groups = collapse(sequences, args.dedup)
+        all_sequences, all_names = sequences, names
+        sequences = [all_sequences[k] for k in representatives]
+        names = [all_names[k] for k in representatives]
+        weights = np.array([len(group) for group in groups], dtype=np.float64)
+        metrics.count('collapsed', len(all_sequences) - len(sequences))
+        print(f'{len(all_sequences)} sequences collapsed into {len(sequences)} representatives\n', file=sys.stderr)
+
+    node = checkpoint.load_tree() if checkpoint is not None else None
+    if node is not None:
+        print('Resuming from the checkpoint...\n', file=sys.stderr)
+    elif args.guide_tree_in is not None:
+        with metrics.stage('tree'):
+            node = read_tree(args.guide_tree_in, names)
+    else:
+        # condensed distances, memory-mapped with --memmap-dir; UPGMA builds the tree in place.
+        # Neighbor joining works on a dense copy and keeps float64, its sums are sensitive to rounding
+        distances = checkpoint.load_distances(args.memmap_dir) if checkpoint is not None else None
+        if distances is None:
+            dtype = np.float64 if args.tree == 'nj' else np.dtype(args.distance_dtype)
+            distances = CondensedMatrix(len(sequences), dtype=dtype, directory=args.memmap_dir)
+            with metrics.stage('distance'):
+                if args.distance == 'ktuple':
+                    k = args.ktuple if args.ktuple is not None else (4 if molecule == 'DNA' else 2)
+                    ktuple_distance_matrix(sequences=sequences, k=k, out=distances)
+                else:
+                    if args.cache_dir is not None:
+                        os.makedirs(args.cache_dir, exist_ok=True)
+                        with ScoreCache(args.cache_dir) as cache:
+                            create_distance_matrix(sequences=sequences, workers=args.threads, cache=cache, band=args.band, out=distances)
+                    else:
+                        create_distance_matrix(sequences=sequences, workers=args.threads, band=args.band, out=distances)
+            if checkpoint is not None:
+                checkpoint.save_distances(distances)
+
+        print('Building the tree...\n', file=sys.stderr)
+
+        with metrics.stage('tree'):
+            if args.tree == 'nj':
+                node = neighbor_joining(dist_matrix=distances)
+            else:
+                node = upgma(dist_matrix=distances)
+        distances.close()
+
+    if checkpoint is not None:
+        checkpoint.save_tree(node)
+
+    if args.guide_tree_out is not None:
+        write_tree(args.guide_tree_out, node, names)
+
+    # ClustalW weights from the guide tree, times the group sizes of collapsed duplicates
+    if args.seq_weights:
+        weights = sequence_weights(node, weights)
+
+    print('Aligning...\n', file=sys.stderr)
+
+    with metrics.stage('align'):
+        try:
+            if args.add is not None:
+                aligned_sequences = add_to_alignment(
+                    alignment=alignment,
+                    sequences=sequences,
+                    guide_tree_root=node,
+                    weight_matrix=weight_matrix,
+                    gap_open = args.gap_open,
+                    gap_extend = args.gap_extension,
+                    workers=args.threads,
+                    band=args.band,
+                    checkpoint=checkpoint,
+                    weights=weights,
+                )
+            else:
+                aligned_sequences = progressive_alignment(
+                    sequences=sequences, 
+                    guide_tree_root=node,
+                    weight_matrix=weight_matrix,
+                    gap_open = args.gap_open,
+                    gap_extend = args.gap_extension,
+                    workers=args.threads,
+                    band=args.band,
+                    checkpoint=checkpoint,
+                    weights=weights,
+                )
+        except KeyError as error:
+            # only a residue without a substitution score points to the wrong molecule type
+            molecules = ['DNA', 'protein']
+            molecules.remove(molecule)
+            raise KeyError(f'Wrong sequence type, try changing it to {molecules[0]}') from error
+
+    print('The alignment is completed.\n\nPreparing the output...\n', file=sys.stderr)
+
+    ids = get_ids_from_guide_tree(node)
+    if args.dedup is not None:
+        offset = len(alignment) if args.add is not None else 0
+        expanded, order = expand(aligned_sequences[offset:], [int(id) for id in ids], all_sequences, groups)
+        aligned_sequences = np.vstack([aligned_sequences[:offset], expanded])
+        ids, names = [str(k) for k in order], all_names
+    if args.add is not None:
+        ids = [str(i) for i in range(len(alignment))] + [str(len(alignment) + int(id)) for id in ids]
+        names = alignment_names + names
+
+    with metrics.stage('write'):
+        write_alignment(ids, names, aligned_sequences, args.output, args.format)
+
+    if args.metrics_json is not None:
+        metrics.dump(args.metrics_json)
+
+    return aligned_sequences
 
-    try:
-        aligned_sequences = progressive_alignment(
-            sequences=sequences, 
-            guide_tree_root=node,
-            weight_matrix=weight_matrix,
-            gap_open = args.gap_open,
-            gap_extend = args.gap_extension
-        )
-    except:
-        molecules = ['DNA', 'protein']
-        molecules.remove(molecule)
-        raise KeyError(f'Wrong sequence type, try changing it to {molecules[0]}')
-    
-    print('The alignment is completed.\n\nPreparing the output...\n')
 
-    ids = get_ids_from_guide_tree(node.id)
+def main_():
+    metrics.show_progress = True
+    run(parse_args())
 
-    fasta_to_clustal(ids, names, aligned_sequences, args.output)
 
 if __name__ == "__main__":
     main_()
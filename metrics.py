@@ -0,0 +1,128 @@
+import json
+import resource
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# counters of the work done in this process: 'dp_cells', 'pairs', 'merges', 'bytes_read', 'bytes_written'
+counters = defaultdict(int)
+# finished stages in the order they ran
+stages = {}
+# whether Progress reports to stderr
+show_progress = False
+
+
+def count(name, value=1):
+    counters[name] += value
+
+
+def peak_rss_mb():
+    # the largest of this process and its finished worker processes
+    peak = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def reset():
+    counters.clear()
+    stages.clear()
+
+
+def collect(function, *args):
+    '''
+    function (callable): function to run, typically in a worker process
+    args: its arguments
+
+    Returns the result of the function and the counters it added, to be passed to 'merge'
+    in the parent process
+    '''
+    before = dict(counters)
+    result = function(*args)
+    return result, {name: value - before.get(name, 0) for name, value in counters.items() if value != before.get(name, 0)}
+
+
+def merge(deltas):
+    '''
+    deltas (dict): counters collected by 'collect'
+    '''
+    for name, value in deltas.items():
+        counters[name] += value
+
+
+@contextmanager
+def stage(name):
+    '''
+    Measures the wall-clock time of the block, the peak RSS at its end and the counters it added
+    '''
+    before, start = dict(counters), time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        added = {key: value - before.get(key, 0) for key, value in counters.items() if value != before.get(key, 0)}
+        stages[name] = {
+            'seconds': seconds,
+            'peak_rss_mb': peak_rss_mb(),
+            'counters': added,
+            'cells_per_second': added['dp_cells'] / seconds if added.get('dp_cells') and seconds > 0 else None,
+        }
+
+
+def report():
+    '''
+    Returns the stages, the totals of the counters and the peak RSS as a dict
+    '''
+    return {
+        'stages': stages,
+        'counters': dict(counters),
+        'total_seconds': sum(value['seconds'] for value in stages.values()),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def dump(f):
+    '''
+    f (str): file for writing the report as JSON
+    '''
+    with open(f, 'w', encoding='utf-8') as file:
+        json.dump(report(), file, indent=2)
+        file.write('\n')
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes:02d}:{seconds:02d}'
+
+
+class Progress:
+    """
+    Progress of a stage with an ETA, reported to stderr when 'show_progress' is set.
+    On a terminal the line is redrawn in place, otherwise a line is written at most
+    every 'interval' seconds
+    """
+
+    def __init__(self, total, label, interval=30.0):
+        self.total, self.label = total, label
+        self.done = 0
+        self.start = self.shown = time.perf_counter()
+        self.tty = sys.stderr.isatty()
+        self.interval = 0.2 if self.tty else interval
+
+    def update(self, value=1):
+        self.done += value
+        now = time.perf_counter()
+        if show_progress and (now - self.shown >= self.interval or self.done >= self.total):
+            self.shown = now
+            self._show(now)
+
+    def _show(self, now):
+        elapsed = now - self.start
+        fraction = self.done / self.total if self.total else 1.0
+        eta = _duration(elapsed / fraction - elapsed) if fraction > 0 else '--:--'
+        line = f'{self.label}: {self.done}/{self.total} ({fraction:.0%}), elapsed {_duration(elapsed)}, ETA {eta}'
+        if self.tty:
+            sys.stderr.write('\r' + line + ('\n' if self.done >= self.total else ''))
+        else:
+            sys.stderr.write(line + '\n')
+        sys.stderr.flush()
@@ -0,0 +1,85 @@
+import numpy as np
+
+from condensed_matrix import CondensedMatrix
+from upgma import UPGMA_Node
+
+
+def _join(first: UPGMA_Node, second: UPGMA_Node, length1: float, length2: float) -> UPGMA_Node:
+    length1, length2 = max(length1, 0.0), max(length2, 0.0)
+    return UPGMA_Node(
+        children=[first, second],
+        height=max(first.height + length1, second.height + length2),
+        branch_lengths=[length1, length2],
+    )
+
+
+def neighbor_joining(dist_matrix: np.ndarray | CondensedMatrix) -> UPGMA_Node:
+    """
+    dist_matrix (np.ndarray | CondensedMatrix): symmetric pairwise distance matrix
+
+    Builds a neighbor-joining tree. The matrix is updated in place: the joined pair takes
+    the slot of its first member and the second slot is switched off; switched off slots
+    are squeezed out once they make up a quarter of the matrix. Row sums are updated
+    incrementally and the Q-matrix is computed with whole-array operations. The tree is
+    rooted at the last join, node heights are the longest distance from a node to its
+    leaves and the branch lengths are kept in 'branch_lengths' (negative estimates are
+    clamped to 0).
+
+    Returns the root node of the tree (UPGMA_Node)
+    """
+    n = len(dist_matrix)
+    clusters = [UPGMA_Node(i) for i in range(n)]
+    if isinstance(dist_matrix, CondensedMatrix):
+        distances = dist_matrix.to_dense()
+    else:
+        distances = np.array(dist_matrix, dtype=np.float64)
+    np.fill_diagonal(distances, 0)
+
+    active = np.ones(n, dtype=bool)
+    row_sums = distances.sum(axis=1)
+    q = np.empty_like(distances)
+
+    for m in range(n, 2, -1):
+        if 4 * m <= 3 * len(active):
+            keep = np.flatnonzero(active)
+            distances = distances[np.ix_(keep, keep)]
+            row_sums = row_sums[keep]
+            clusters = [clusters[k] for k in keep]
+            active = np.ones(m, dtype=bool)
+            q = np.empty_like(distances)
+
+        # Q[i, j] = (m - 2) * D[i, j] - r[i] - r[j]; the r[i] term is the same for the whole
+        # row, so it is added to the row minima only. Switched off slots get -inf row sums,
+        # so their Q values are +inf
+        sums = np.where(active, row_sums, -np.inf)
+        np.multiply(distances, m - 2, out=q)
+        q -= sums[None, :]
+        np.fill_diagonal(q, np.inf)
+        nearest = q.argmin(axis=1)
+        row_q = q[np.arange(len(q)), nearest] - sums
+        i = np.argmin(row_q)
+        i, j = sorted((i, nearest[i]))
+
+        d_ij = distances[i, j]
+        length_i = d_ij / 2 + (row_sums[i] - row_sums[j]) / (2 * (m - 2))
+        length_j = d_ij - length_i
+
+        merged = (distances[i] + distances[j] - d_ij) / 2
+        active[j] = False
+        merged[~active] = 0
+        merged[i] = 0
+
+        row_sums += merged - distances[i] - distances[j]
+        row_sums[i] = merged.sum()
+        row_sums[j] = 0
+        distances[i], distances[:, i] = merged, merged
+        distances[j], distances[:, j] = 0, 0
+
+        clusters[i], clusters[j] = _join(clusters[i], clusters[j], length_i, length_j), None
+
+    remaining = np.flatnonzero(active)
+    if len(remaining) == 1:
+        return clusters[remaining[0]]
+
+    i, j = remaining
+    return _join(clusters[i], clusters[j], distances[i, j] / 2, distances[i, j] / 2)
@@ -0,0 +1,130 @@
+import re
+
+from upgma import UPGMA_Node
+
+_TOKEN = re.compile(r"\s*(?:\[[^\]]*\]\s*)*('(?:[^']|'')*'|[(),:;]|[^\s()\[\],:;']+)")
+_SPECIAL = set("()[]':;, \t\n")
+
+
+def _quote(label: str) -> str:
+    if _SPECIAL.intersection(label):
+        return "'" + label.replace("'", "''") + "'"
+    return label
+
+
+def _unquote(token: str) -> str:
+    if token.startswith("'"):
+        return token[1:-1].replace("''", "'")
+    return token
+
+
+def to_newick(root: UPGMA_Node, names=None) -> str:
+    '''
+    root (UPGMA_Node): root of the guide tree
+    names (list): names of sequences, leaves are labelled by their index if not given
+
+    Returns the tree in Newick format with branch lengths, written exactly (shortest repr of
+    the floats) so a tree read back gives the same sequence weights
+    '''
+    parts = []
+    stack = [(root, None)]
+    while stack:
+        item, length = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+
+        suffix = '' if length is None else f':{length!r}'
+        if not item.children:
+            parts.append(_quote(names[item.id] if names is not None else str(item.id)) + suffix)
+            continue
+
+        parts.append('(')
+        stack.append((')' + suffix, None))
+        for k in reversed(range(len(item.children))):
+            stack.append((item.children[k], float(item.branch_lengths[k])))
+            if k:
+                stack.append((',', None))
+
+    return ''.join(parts) + ';'
+
+
+def _node(children: list) -> UPGMA_Node:
+    '''
+    children (list): (node, branch length) pairs of a bracket
+
+    Returns the node of the bracket, brackets with more than two children
+    are resolved into a ladder of binary nodes with zero-length inner branches
+    '''
+    node, length = children[0]
+    if len(children) == 1:
+        return node
+
+    for child, child_length in children[1:]:
+        lengths = [length or 0.0, child_length or 0.0]
+        node = UPGMA_Node(
+            children=[node, child],
+            height=max(node.height + lengths[0], child.height + lengths[1]),
+            branch_lengths=lengths,
+        )
+        length = 0.0
+    return node
+
+
+def from_newick(text: str, names: list) -> UPGMA_Node:
+    '''
+    text (str): tree in Newick format, leaves are labelled by the names of sequences
+    names (list): names of sequences
+
+    Returns the root of the guide tree, leaf ids are indices in 'names'.
+    Labels of internal nodes are ignored and missing branch lengths are read as 0
+    '''
+    index = {name: i for i, name in enumerate(names)}
+    seen = set()
+    groups = [[]]
+    node, length, expect_length = None, None, False
+
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            raise ValueError(f'Malformed Newick tree at position {position}')
+        position = match.end()
+        token = match.group(1)
+
+        if token == '(':
+            groups.append([])
+        elif token in ',);':
+            if node is not None:
+                groups[-1].append((node, length))
+            node, length = None, None
+            if token == ')':
+                if len(groups) == 1 or not groups[-1]:
+                    raise ValueError('Unbalanced brackets in the Newick tree')
+                node = _node(groups.pop())
+            elif token == ';':
+                break
+        elif token == ':':
+            expect_length = True
+        elif expect_length:
+            length = float(token)
+            expect_length = False
+        elif node is None:
+            label = _unquote(token)
+            if label not in index:
+                raise ValueError(f"Leaf '{label}' of the guide tree is not among the sequences")
+            if label in seen:
+                raise ValueError(f"Leaf '{label}' occurs twice in the guide tree")
+            seen.add(label)
+            node = UPGMA_Node(index[label])
+
+    if node is not None:
+        groups[-1].append((node, length))
+    if len(groups) != 1 or not groups[0]:
+        raise ValueError('Unbalanced brackets in the Newick tree')
+    if len(seen) != len(index):
+        missing = [name for name in names if name not in seen]
+        raise ValueError(f'Sequences missing from the guide tree: {", ".join(missing)}')
+
+    return _node(groups[0])
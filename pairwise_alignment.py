@@ -1,203 +1,843 @@
-from typing import Callable
 import numpy as np
 
+import metrics
+import scoring
+from alphabet import GAP, as_codes
 
-def needleman_wunsch(seq1, seq2, match=1, mismatch=1, gap=1):
+
+# cells of the full DP matrices above which 'base_needleman_wunsch_affine' switches
+# to the linear-space mode
+MAX_DP_CELLS = 1 << 24
+
+# packed traceback bits: source of the dp value (0 - diagonal, 1 - I1, 2 - I2)
+# and whether I1 / I2 extends a gap of the previous cell or opens a new one
+TRACE_DIRECTION = 3
+TRACE_I1_EXTEND = 4
+TRACE_I2_EXTEND = 8
+
+
+class SubstitutionScores:
     '''
-    seq1 (str): first sequence to align
-    seq2 (str): first sequence to align
-    match (int): score for matching characters
-    mismatch (int): penalty for mismatching characters
-    gap (int): penalty for gaps
+    Substitution scores of two encoded sequences, s(i, j) = matrix[codes1[i], codes2[j]],
+    evaluated only for the requested cells
+    '''
+    def __init__(self, codes1, codes2, matrix):
+        self.codes1, self.codes2, self.matrix = codes1, codes2, matrix
+        self.shape = (len(codes1), len(codes2))
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if isinstance(rows, slice):
+            return self.matrix[np.ix_(self.codes1[rows], self.codes2[cols])]
+        return self.matrix[self.codes1[rows], self.codes2[cols]]
+
+
+class ProfileScores:
+    '''
+    Substitution scores of two profiles, s(i, j) = left[i] @ right[j],
+    evaluated only for the requested cells
+    '''
+    def __init__(self, left, right):
+        self.left, self.right = left, right
+        self.shape = (len(left), len(right))
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if isinstance(rows, slice):
+            return self.left[rows] @ self.right[cols].T
+        return np.einsum('ij,ij->i', self.left[rows], self.right[cols])
 
-    Returns a tuple of two aligned sequences, a score matrix and a final score of the alignment
+
+def affine_edges(l1, l2, gap_open=1.0, gap_extend=0.5):
+    '''
+    l1 (int): length of the first sequence
+    l2 (int): length of the second sequence
+    gap_open (float): penalty for opening gaps
+    gap_extend (float): penalty for extending gaps
+
+    Returns the first row of dp and I1 and the first column of dp and I2 for the affine gap model
+    '''
+    top_dp, left_dp = np.zeros(l2 + 1), np.zeros(l1 + 1)
+    top_dp[1:] = np.linspace(-gap_open, -(l2-1) * gap_extend, l2)
+    left_dp[1:] = np.linspace(-gap_open, -(l1-1) * gap_extend, l1)
+
+    return top_dp, np.zeros(l2 + 1), left_dp, np.zeros(l1 + 1)
+
+
+def linear_edges(l1, l2, gap=1.0):
+    '''
+    l1 (int): length of the first sequence
+    l2 (int): length of the second sequence
+    gap (float): penalty for gaps
+
+    Returns the first row of dp and I1 and the first column of dp and I2 such that the affine
+    recursion with gap_open == gap_extend == gap reproduces the linear gap model
     '''
+    top_gap, left_gap = np.full(l2 + 1, -np.inf), np.full(l1 + 1, -np.inf)
+
+    return np.linspace(0, -l2 * gap, l2 + 1), top_gap, np.linspace(0, -l1 * gap, l1 + 1), left_gap
 
-    l1, l2 = len(seq1), len(seq2)
-    dp = np.zeros((l1 + 1, l2 + 1))
-    dp[:,0] = np.linspace(0, -l1 * gap, l1 + 1)
-    dp[0,:] = np.linspace(0, -l2 * gap, l2 + 1)
-    traceback = np.zeros((l1 + 1, l2 + 1))
 
-    for i in range(1, l1+1):
-        for j in range(1, l2+1):
+def init_matrices(edges):
+    '''
+    edges (tuple): first row of dp and I1, first column of dp and I2
+
+    Returns score matrix dp and gap matrices I1, I2 with the first row and column initialised
+    '''
+    top_dp, top_gap, left_dp, left_gap = edges
+    l1, l2 = len(left_dp) - 1, len(top_dp) - 1
+    dp, I1, I2 = np.zeros((l1 + 1, l2 + 1)), np.zeros((l1 + 1, l2 + 1)), np.zeros((l1 + 1, l2 + 1))
+    dp[0,:], I1[0,:] = top_dp, top_gap
+    dp[:,0], I2[:,0] = left_dp, left_gap
+    I1[1:,0], I2[0,1:] = -np.inf, -np.inf
 
-            if seq1[i-1] == seq2[j-1]:
-                diag_score = dp[i-1][j-1] + match
-            else:
-                diag_score = dp[i-1][j-1] - mismatch
-            up_score = dp[i-1][j] - gap
-            left_score = dp[i][j-1] - gap
+    return dp, I1, I2
 
-            scores = (diag_score, up_score, left_score)
-            max_direction = np.argmax(scores)
-            
-            dp[i][j] = scores[max_direction]
-            traceback[i][j] = max_direction
-            
-    align_seq1, align_seq2 = [], []
+
+def affine_wavefront(scores, dp, I1, I2, gap_open=1.0, gap_extend=0.5):
+    '''
+    scores (np.ndarray): (l1, l2) substitution scores, scores[i, j] is the score of
+                         aligning position i of the first sequence with position j of the second
+    dp, I1, I2 (np.ndarray): (l1 + 1, l2 + 1) matrices with initialised first row and column,
+                             filled in place
+    gap_open (float): penalty for opening gaps
+    gap_extend (float): penalty for extending gaps
+
+    Fills the matrices one anti-diagonal at a time: every cell of an anti-diagonal depends
+    only on the two previous ones, so each of them is computed with whole-array operations.
+    The arithmetic per cell is the same as in the cell-by-cell recursion.
+
+    Returns the uint8 traceback matrix: the TRACE_DIRECTION bits hold the source of the dp
+    value (0 - diagonal, 1 - gap in the second sequence, 2 - gap in the first one),
+    TRACE_I1_EXTEND / TRACE_I2_EXTEND are set when I1 / I2 extends the gap of the previous cell
+    '''
+    l1, l2 = scores.shape
+    traceback = np.zeros((l1 + 1, l2 + 1), dtype=np.uint8)
+    if l1 == 0 or l2 == 0:
+        return traceback
+    metrics.count('dp_cells', l1 * l2)
+
+    scores = np.ascontiguousarray(scores[0:l1, 0:l2], dtype=np.float64).reshape(-1)
+    dp_flat, I1_flat, I2_flat = dp.reshape(-1), I1.reshape(-1), I2.reshape(-1)
+    tb_flat = traceback.reshape(-1)
+
+    # cell (i, j) lives at i * (l2 + 1) + j of the flattened matrices, so the cells of
+    # the anti-diagonal i + j == d are a slice with step l2, and so are their neighbours
+    width = l2 + 1
+    score_step = max(l2 - 1, 1)
+
+    for d in range(2, l1 + l2 + 1):
+        lo, hi = max(1, d - l2), min(l1, d - 1)
+        span = (hi - lo) * l2 + 1
+        start = lo * l2 + d
+        score_start = lo * (l2 - 1) + d - l2 - 1
+
+        cells = slice(start, start + span, l2)
+        up = slice(start - width, start - width + span, l2)
+        left = slice(start - 1, start - 1 + span, l2)
+        diag = slice(start - width - 1, start - width - 1 + span, l2)
+
+        diag_score = dp_flat[diag] + scores[score_start:score_start + (hi - lo) * score_step + 1:score_step]
+        extend1, open1 = I1_flat[up] - gap_extend, dp_flat[up] - gap_open
+        extend2, open2 = I2_flat[left] - gap_extend, dp_flat[left] - gap_open
+        gap1, gap2 = np.maximum(extend1, open1), np.maximum(extend2, open2)
+
+        I1_flat[cells] = gap1
+        I2_flat[cells] = gap2
+        dp_flat[cells] = np.maximum(np.maximum(diag_score, gap1), gap2)
+        tb_flat[cells] = (
+            np.where((diag_score >= gap1) & (diag_score >= gap2), 0, np.where(gap1 >= gap2, 1, 2))
+            | np.where(extend1 >= open1, TRACE_I1_EXTEND, 0)
+            | np.where(extend2 >= open2, TRACE_I2_EXTEND, 0)
+        ).astype(np.uint8)
+
+    return traceback
+
+
+def traceback_indices(traceback, l1, l2, tails=True):
+    '''
+    traceback (np.ndarray): traceback matrix filled by 'affine_wavefront'
+    l1 (int): length of the first sequence
+    l2 (int): length of the second sequence
+    tails (bool): whether to finish the path along the first row or column
+
+    Returns two arrays of aligned positions of the first and the second sequence, -1 marks a gap
+    '''
+    path1, path2 = [], []
     i, j = l1, l2
 
     while i > 0 and j > 0:
-        if traceback[i][j] == 0:
-            align_seq1.append(seq1[i-1])
-            align_seq2.append(seq2[j-1])
+        direction = traceback[i][j] & TRACE_DIRECTION
+        if direction == 0:
+            path1.append(i - 1)
+            path2.append(j - 1)
             i -= 1
             j -= 1
-        elif traceback[i][j] == 1:
-            align_seq1.append(seq1[i-1])
-            align_seq2.append('-')
+        elif direction == 1:
+            path1.append(i - 1)
+            path2.append(-1)
             i -= 1
         else:
-            align_seq1.append('-')
-            align_seq2.append(seq2[j-1])
+            path1.append(-1)
+            path2.append(j - 1)
+            j -= 1
+
+    if tails:
+        while i > 0:
+            path1.append(i - 1)
+            path2.append(-1)
+            i -= 1
+        while j > 0:
+            path1.append(-1)
+            path2.append(j - 1)
             j -= 1
 
-    align_seq1 = ''.join(reversed(align_seq1))
-    align_seq2 = ''.join(reversed(align_seq2))
-    
-    return align_seq1, align_seq2, dp, dp[l1][l2]
+    return np.array(path1[::-1], dtype=np.int64), np.array(path2[::-1], dtype=np.int64)
 
 
-def needleman_wunsch_affine(seq1, seq2, match=1, mismatch=1, gap_open=1, gap_extend=0.5):
+def _kmer_positions(codes, k):
     '''
-    seq1 (str): first sequence to align
-    seq2 (str): first sequence to align
-    match (int): score for matching characters
-    mismatch (int): penalty for mismatching characters
-    gap_open (int): penalty for opening gaps
+    Returns ids and start positions of the k-tuples of an integer sequence,
+    k-tuples with negative codes are skipped
+    '''
+    codes = np.asarray(codes, dtype=np.int64)
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    base = int(codes.max()) + 1
+    ids, valid = np.zeros(n, dtype=np.int64), np.ones(n, dtype=bool)
+    for shift in range(k):
+        window = codes[shift:shift + n]
+        ids = ids * base + window
+        valid &= window >= 0
+
+    return ids[valid], np.flatnonzero(valid)
+
+
+def estimate_band(codes1, codes2, margin=16):
+    '''
+    codes1, codes2 (np.ndarray): sequences as integer codes, negative codes are ignored
+    margin (int): number of diagonals added on both sides of the band
+
+    Finds the diagonals j - i of the k-tuples that occur exactly once in both sequences,
+    k is chosen so that random hits are rare. Diagonals with a single hit are treated as noise.
+
+    Returns the band (k_lo, k_hi) of diagonals holding the hits and the diagonals of both
+    ends of the matrices, or None if the sequences share no repeated diagonal
+    '''
+    l1, l2 = len(codes1), len(codes2)
+    codes1, codes2 = np.asarray(codes1, dtype=np.int64), np.asarray(codes2, dtype=np.int64)
+    symbols = np.unique(np.concatenate([codes1[codes1 >= 0], codes2[codes2 >= 0]]))
+    codes1 = np.where(codes1 >= 0, np.searchsorted(symbols, codes1), -1)
+    codes2 = np.where(codes2 >= 0, np.searchsorted(symbols, codes2), -1)
+    n_codes = len(symbols)
+    k = max(3, int(np.ceil(np.log(max(l1, l2, 2)) / np.log(max(n_codes, 2)))) + 1)
+    while n_codes ** k >= 1 << 62:
+        k -= 1
+
+    uniques = []
+    for codes in (codes1, codes2):
+        ids, positions = _kmer_positions(codes, k)
+        values, first, counts = np.unique(ids, return_index=True, return_counts=True)
+        uniques.append((values[counts == 1], positions[first[counts == 1]]))
+
+    (values1, positions1), (values2, positions2) = uniques
+    _, index1, index2 = np.intersect1d(values1, values2, assume_unique=True, return_indices=True)
+    hits = np.bincount(positions2[index2] - positions1[index1] + l1, minlength=l1 + l2 + 1)
+    diagonals = np.flatnonzero(hits >= 2) - l1
+    if not len(diagonals):
+        return None
+
+    return (
+        min(int(diagonals.min()), 0, l2 - l1) - margin,
+        max(int(diagonals.max()), 0, l2 - l1) + margin,
+    )
+
+
+def band_limits(l1, l2, band, codes1=None, codes2=None):
+    '''
+    l1 (int): length of the first sequence
+    l2 (int): length of the second sequence
+    band (int | str): number of diagonals on both sides of the diagonals of the matrix ends,
+                      'auto' to estimate the band from k-tuple hits (needs codes1, codes2), or None
+    codes1, codes2 (np.ndarray): sequences as integer codes
+
+    Returns the band (k_lo, k_hi) of diagonals j - i, or None
+    '''
+    if band is None:
+        return None
+    if band == 'auto':
+        return estimate_band(codes1, codes2)
+    return min(0, l2 - l1) - int(band), max(0, l2 - l1) + int(band)
+
+
+def banded_wavefront(scores, edges, band, gap_open=1.0, gap_extend=0.5, tails=True):
+    '''
+    scores: (l1, l2) substitution scores (array, SubstitutionScores or ProfileScores)
+    edges (tuple): first row of dp and I1, first column of dp and I2
+    band (tuple): diagonals (k_lo, k_hi), only the cells with k_lo <= j - i <= k_hi are computed
+    gap_open (float): penalty for opening gaps
     gap_extend (float): penalty for extending gaps
+    tails (bool): whether the traceback finishes along the first row or column
+
+    Runs the recursion of 'affine_wavefront' inside the band. Row i of the band is stored at
+    i * (width + 1) with cell (i, j) at offset j - i - k_lo; the extra pad column holds -inf and
+    stands for the cells just outside the band on both sides. An anti-diagonal of the band is
+    again a strided slice of the flattened storage.
 
-    Returns a tuple of two aligned sequences, a score matrix and a final score of the alignment
+    Returns two arrays of aligned positions (-1 marks a gap) and the final score, or None if
+    the path touches the edge of the band (a better path may leave the band)
     '''
+    top_dp, top_gap, left_dp, left_gap = edges
+    l1, l2 = len(left_dp) - 1, len(top_dp) - 1
+    k_lo, k_hi = band
+    width = k_hi - k_lo + 1
+    stride = width + 1
 
-    l1, l2 = len(seq1), len(seq2)
-    dp = np.zeros((l1 + 1, l2 + 1))
-    dp[1:,0] = np.linspace(-gap_open, -(l1-1) * gap_extend, l1)
-    dp[0,1:] = np.linspace(-gap_open, -(l2-1) * gap_extend, l2)
+    dp, I1, I2 = (np.full((l1 + 1) * stride, -np.inf) for _ in range(3))
+    traceback = np.zeros((l1 + 1) * stride, dtype=np.uint8)
 
-    I1, I2 = np.zeros((l1 + 1, l2 + 1)), np.zeros((l1 + 1, l2 + 1))
-    I1[1:,0] = np.linspace(-gap_open, -(l1-1) * gap_extend, l1)
-    I2[0,1:] = np.linspace(-gap_open, -(l2-1) * gap_extend, l2)
+    columns = np.arange(max(0, k_lo), min(l2, k_hi) + 1)
+    dp[columns - k_lo], I1[columns - k_lo] = top_dp[columns], top_gap[columns]
+    rows = np.arange(max(0, -k_hi), min(l1, -k_lo) + 1)
+    dp[rows * (stride - 1) - k_lo], I2[rows * (stride - 1) - k_lo] = left_dp[rows], left_gap[rows]
 
-    traceback = np.zeros((l1 + 1, l2 + 1))
+    step = max(stride - 2, 1)
+    computed = 0
+    for d in range(2, l1 + l2 + 1):
+        lo = max(1, d - l2, -((k_hi - d) // 2))
+        hi = min(l1, d - 1, (d - k_lo) // 2)
+        if lo > hi:
+            continue
+        computed += hi - lo + 1
+        rows = np.arange(lo, hi + 1)
+        start = lo * (stride - 2) + d - k_lo
+        span = (hi - lo) * step + 1
 
-    for i in range(1, l1+1):
-        for j in range(1, l2+1):
-            if seq1[i-1] == seq2[j-1]:
-                diag_score = dp[i-1][j-1] + match
-            else:
-                diag_score = dp[i-1][j-1] - mismatch
-            I1[i][j] = max(I1[i-1][j] - gap_extend, dp[i-1][j] - gap_open)
-            I2[i][j] = max(I2[i][j-1] - gap_extend, dp[i][j-1] - gap_open)
+        cells = slice(start, start + span, step)
+        up = slice(start - stride + 1, start - stride + 1 + span, step)
+        left = slice(start - 1, start - 1 + span, step)
+        diag = slice(start - stride, start - stride + span, step)
 
-            scores = (diag_score, I1[i][j], I2[i][j])
-            max_direction = np.argmax(scores)
-            
-            dp[i][j] = scores[max_direction]
-            traceback[i][j] = max_direction
-            
-    align_seq1, align_seq2 = [], []
-    i, j = l1, l2
+        diag_score = dp[diag] + scores[rows - 1, d - rows - 1]
+        extend1, open1 = I1[up] - gap_extend, dp[up] - gap_open
+        extend2, open2 = I2[left] - gap_extend, dp[left] - gap_open
+        gap1, gap2 = np.maximum(extend1, open1), np.maximum(extend2, open2)
+
+        I1[cells] = gap1
+        I2[cells] = gap2
+        dp[cells] = np.maximum(np.maximum(diag_score, gap1), gap2)
+        traceback[cells] = np.where((diag_score >= gap1) & (diag_score >= gap2), 0, np.where(gap1 >= gap2, 1, 2))
+    metrics.count('dp_cells', computed)
 
+    path1, path2 = [], []
+    i, j = l1, l2
+    edge_lo, edge_hi = (k_lo if k_lo > -l1 else None), (k_hi if k_hi < l2 else None)
     while i > 0 and j > 0:
-        if traceback[i][j] == 0:
-            align_seq1.append(seq1[i-1])
-            align_seq2.append(seq2[j-1])
-            i -= 1
-            j -= 1
-        elif traceback[i][j] == 1:
-            align_seq1.append(seq1[i-1])
-            align_seq2.append('-')
+        if j - i in (edge_lo, edge_hi):
+            return None
+        direction = traceback[i * stride + j - i - k_lo]
+        if direction == 0:
+            path1.append(i - 1)
+            path2.append(j - 1)
+            i, j = i - 1, j - 1
+        elif direction == 1:
+            path1.append(i - 1)
+            path2.append(-1)
             i -= 1
         else:
-            align_seq1.append('-')
-            align_seq2.append(seq2[j-1])
+            path1.append(-1)
+            path2.append(j - 1)
             j -= 1
-    
-    while i > 0:
-        align_seq1.append(seq1[i - 1]) 
-        align_seq2.append('-')
-        i -= 1
-    while j > 0:
-        align_seq1.append('-')
-        align_seq2.append(seq2[j - 1])
-        j -= 1
-
-    align_seq1 = ''.join(reversed(align_seq1))
-    align_seq2 = ''.join(reversed(align_seq2))
-    
-    return align_seq1, align_seq2, dp, dp[l1][l2]
 
+    if tails:
+        if (i > 0 and edge_lo is not None and -i <= edge_lo) or (j > 0 and edge_hi is not None and j >= edge_hi):
+            return None
+        path1 += list(range(i - 1, -1, -1)) + [-1] * j
+        path2 += [-1] * i + list(range(j - 1, -1, -1))
 
-def base_needleman_wunsch_affine(
-    seq1_len: int,
-    seq2_len: int,
-    weight_gen: Callable[[int, int], float],
-    gap_open: float = 1.0,
-    gap_extend: float = 0.5,
-):
+    score = dp[l1 * stride + l2 - l1 - k_lo]
+    return np.array(path1[::-1], dtype=np.int64), np.array(path2[::-1], dtype=np.int64), score
+
+
+def _forward_scan(scores, origin, edges, gap_open, gap_extend, mid=None):
     '''
-    seq1_len: (int) length of first sequence
-    seq2_len: (int) first sequence to align
-    weight_gen: (callable) universal weight generator
-    gap_open (int): penalty for opening gaps
+    scores: substitution scores of the whole problem (array, SubstitutionScores or ProfileScores)
+    origin (tuple): position (r0, c0) of the block in the score matrix
+    edges (tuple): first row of dp and I1, first column of dp and I2 of the block
+    gap_open (float): penalty for opening gaps
     gap_extend (float): penalty for extending gaps
+    mid (int): row of the block to find the crossing of the optimal paths with
+
+    Runs the recursion of 'affine_wavefront' over the block keeping only the last anti-diagonals,
+    so the memory is linear in the block height. If mid is given, every cell below it also
+    carries a pointer to the place where its best path leaves row mid:
+    4 * column + kind, kind 0 - diagonal step from (mid, column), 1 / 2 - vertical step from the
+    dp / I1 value of (mid, column), 3 - the path runs down the first column.
 
-    Returns a tuple of two aligned sequences, a score matrix and a final score of the alignment
+    Returns dp and I1 of the last cell and, if mid is given, their pointers and the dp and I1 rows mid
     '''
+    (r0, c0), (top_dp, top_gap, left_dp, left_gap) = origin, edges
+    h, w = len(left_dp) - 1, len(top_dp) - 1
+    metrics.count('dp_cells', h * w)
+    dp = [np.full(h + 1, -np.inf) for _ in range(3)]
+    I1 = [np.full(h + 1, -np.inf) for _ in range(2)]
+    I2 = [np.full(h + 1, -np.inf) for _ in range(2)]
+    dp[0][0] = top_dp[0]
+    dp[1][0], I1[1][0] = top_dp[1], top_gap[1]
+    dp[1][1], I2[1][1] = left_dp[1], left_gap[1]
 
-    l1, l2 = seq1_len, seq2_len
-    dp = np.zeros((l1 + 1, l2 + 1))
-    dp[1:,0] = np.linspace(-gap_open, -(l1-1) * gap_extend, l1)
-    dp[0,1:] = np.linspace(-gap_open, -(l2-1) * gap_extend, l2)
+    if mid is not None:
+        ptr_dp = [np.full(h + 1, -1, dtype=np.int64) for _ in range(3)]
+        ptr_I1 = [np.full(h + 1, -1, dtype=np.int64) for _ in range(2)]
+        ptr_I2 = [np.full(h + 1, -1, dtype=np.int64) for _ in range(2)]
+        mid_dp, mid_I1 = np.full(w + 1, -np.inf), np.full(w + 1, -np.inf)
+        mid_dp[0] = left_dp[mid]
 
-    I1, I2 = np.zeros((l1 + 1, l2 + 1)), np.zeros((l1 + 1, l2 + 1))
-    I1[1:,0] = np.linspace(-gap_open, -(l1-1) * gap_extend, l1)
-    I2[0,1:] = np.linspace(-gap_open, -(l2-1) * gap_extend, l2)
+    for d in range(2, h + w + 1):
+        lo, hi = max(1, d - w), min(h, d - 1)
+        rows = np.arange(lo, hi + 1)
+        prev2, prev, new = dp[(d - 2) % 3], dp[(d - 1) % 3], dp[d % 3]
+        prev_I1, new_I1 = I1[(d - 1) % 2], I1[d % 2]
+        prev_I2, new_I2 = I2[(d - 1) % 2], I2[d % 2]
 
-    traceback = np.zeros((l1 + 1, l2 + 1))
+        diag_score = prev2[lo - 1:hi] + scores[r0 + rows - 1, c0 + d - rows - 1]
+        extend1, open1 = prev_I1[lo - 1:hi] - gap_extend, prev[lo - 1:hi] - gap_open
+        extend2, open2 = prev_I2[lo:hi + 1] - gap_extend, prev[lo:hi + 1] - gap_open
+        gap1, gap2 = np.maximum(extend1, open1), np.maximum(extend2, open2)
+        direction = np.where((diag_score >= gap1) & (diag_score >= gap2), 0, np.where(gap1 >= gap2, 1, 2))
 
-    for i in range(1, l1 +1 ):
-        for j in range(1, l2 + 1):
-            diag_score = dp[i - 1][j - 1] + weight_gen(i - 1, j - 1)
-            I1[i][j] = max(I1[i - 1][j] - gap_extend, dp[i - 1][j] - gap_open)
-            I2[i][j] = max(I2[i][j - 1] - gap_extend, dp[i][j - 1] - gap_open)
+        if mid is not None:
+            from1 = np.where(extend1 >= open1, ptr_I1[(d - 1) % 2][lo - 1:hi], ptr_dp[(d - 1) % 3][lo - 1:hi])
+            from2 = np.where(extend2 >= open2, ptr_I2[(d - 1) % 2][lo:hi + 1], ptr_dp[(d - 1) % 3][lo:hi + 1])
+            from_diag = ptr_dp[(d - 2) % 3][lo - 1:hi]
+            if lo <= mid + 1 <= hi:
+                k, column = mid + 1 - lo, d - mid - 1
+                from1[k] = 4 * column + (2 if extend1[k] >= open1[k] else 1)
+                from_diag[k] = 4 * (column - 1)
+            ptr_dp[d % 3][lo:hi + 1] = np.choose(direction, (from_diag, from1, from2))
+            ptr_I1[d % 2][lo:hi + 1] = from1
+            ptr_I2[d % 2][lo:hi + 1] = from2
 
-            scores = (diag_score, I1[i][j], I2[i][j])
-            max_direction = np.argmax(scores)
-            
-            dp[i][j] = scores[max_direction]
-            traceback[i][j] = max_direction
-            
-    align_seq1, align_seq2 = [], []
-    i, j = l1, l2
+        new_I1[lo:hi + 1] = gap1
+        new_I2[lo:hi + 1] = gap2
+        new[lo:hi + 1] = np.maximum(np.maximum(diag_score, gap1), gap2)
+
+        if d <= w:
+            new[0], new_I1[0] = top_dp[d], top_gap[d]
+        if d <= h:
+            new[d], new_I2[d] = left_dp[d], left_gap[d]
+            if mid is not None and d > mid:
+                ptr_dp[d % 3][d] = ptr_I2[d % 2][d] = 3
+        if mid is not None and lo <= mid <= hi:
+            mid_dp[d - mid], mid_I1[d - mid] = new[mid], new_I1[mid]
+
+    last = (h + w) % 3, (h + w) % 2
+    if mid is None:
+        return dp[last[0]][h], I1[last[1]][h]
+    return (dp[last[0]][h], I1[last[1]][h], ptr_dp[last[0]][h], ptr_I1[last[1]][h], mid_dp, mid_I1)
 
+
+def _block_moves(scores, origin, edges, gap_open, gap_extend, end_state):
+    '''
+    Aligns the block with the full matrices and follows the gap states back from
+    the last cell in end_state (0 - dp, 1 - I1)
+
+    Returns the moves of the path (0 - diagonal, 1 - gap in the second sequence,
+    2 - gap in the first one)
+    '''
+    (r0, c0), h, w = origin, len(edges[2]) - 1, len(edges[0]) - 1
+    dp, I1, I2 = init_matrices(edges)
+    traceback = affine_wavefront(scores[r0:r0 + h, c0:c0 + w], dp, I1, I2, gap_open, gap_extend)
+
+    moves, i, j, state = [], h, w, end_state
     while i > 0 and j > 0:
-        if traceback[i][j] == 0:
-            align_seq1.append(i - 1)
-            align_seq2.append(j - 1)
-            i -= 1
-            j -= 1
-        elif traceback[i][j] == 1:
-            align_seq1.append(i - 1)
-            align_seq2.append('-')
+        if state == 0:
+            state = traceback[i, j] & TRACE_DIRECTION
+            if state == 0:
+                moves.append(0)
+                i, j = i - 1, j - 1
+        elif state == 1:
+            moves.append(1)
+            state = 1 if traceback[i, j] & TRACE_I1_EXTEND else 0
             i -= 1
         else:
-            align_seq1.append('-')
-            align_seq2.append(j - 1)
+            moves.append(2)
+            state = 2 if traceback[i, j] & TRACE_I2_EXTEND else 0
             j -= 1
-    
-    while i > 0:
-        align_seq1.append(i - 1) 
-        align_seq2.append('-')
-        i -= 1
-    while j > 0:
-        align_seq1.append('-')
-        align_seq2.append(j - 1)
-        j -= 1
-
-    align_seq1 = list(reversed(align_seq1))
-    align_seq2 = list(reversed(align_seq2))
-
-    return align_seq1, align_seq2, dp, dp[l1][l2]
+
+    return [1] * i + [2] * j + moves[::-1]
+
+
+def _linear_space_moves(scores, origin, edges, gap_open, gap_extend, end_state, max_cells):
+    '''
+    Divide and conquer alignment of the block in linear space: a forward scan finds where the
+    best path crosses the middle row, then the blocks above and below the crossing are aligned
+    the same way until they fit into max_cells.
+
+    Returns the moves of the path (see '_block_moves')
+    '''
+    top_dp, top_gap, left_dp, left_gap = edges
+    h, w = len(left_dp) - 1, len(top_dp) - 1
+    if h == 0 or w == 0:
+        return [1] * h + [2] * w
+    if h == 1 or (h + 1) * (w + 1) <= max_cells:
+        return _block_moves(scores, origin, edges, gap_open, gap_extend, end_state)
+
+    mid = h // 2
+    _, _, ptr_dp, ptr_I1, mid_dp, mid_I1 = _forward_scan(scores, origin, edges, gap_open, gap_extend, mid)
+    pointer = ptr_dp if end_state == 0 else ptr_I1
+    column, kind = divmod(int(pointer), 4)
+    (r0, c0), closed = origin, np.full(w + 1, -np.inf)
+
+    if kind == 3:
+        upper = [1] * mid
+        column, start = 0, left_dp[mid]
+        lower_left = (left_dp[mid:], left_gap[mid:])
+    else:
+        upper = _linear_space_moves(
+            scores, origin, (top_dp[:column + 1], top_gap[:column + 1], left_dp[:mid + 1], left_gap[:mid + 1]),
+            gap_open, gap_extend, 1 if kind == 2 else 0, max_cells,
+        )
+        lower_left = (np.full(h - mid + 1, -np.inf), np.full(h - mid + 1, -np.inf))
+        start = mid_dp[column] if kind != 2 else -np.inf
+        if kind == 0:
+            lower_left[0][0] = start
+        else:
+            # the path goes down from (mid, column), the first column of the lower block
+            # holds the values of that vertical gap
+            first = mid_dp[column] - gap_open if kind == 1 else mid_I1[column] - gap_extend
+            steps = np.full(h - mid, -min(gap_open, gap_extend), dtype=np.float64)
+            steps[0] = first
+            lower_left[0][0], lower_left[0][1:] = start, np.cumsum(steps)
+
+    lower_top = closed[column:].copy()
+    lower_top[0] = start
+    lower = _linear_space_moves(
+        scores, (r0 + mid, c0 + column), (lower_top, closed[column:], lower_left[0], lower_left[1]),
+        gap_open, gap_extend, end_state, max_cells,
+    )
+
+    return upper + lower
+
+
+def _moves_to_path(moves):
+    '''
+    Returns two arrays of aligned positions (-1 marks a gap) for the moves of a path
+    '''
+    moves = np.array(moves, dtype=np.int64)
+    step1, step2 = moves != 2, moves != 1
+    path1 = np.where(step1, np.cumsum(step1) - 1, -1)
+    path2 = np.where(step2, np.cumsum(step2) - 1, -1)
+
+    return path1, path2
+
+
+def align(scores, edges, gap_open=1.0, gap_extend=0.5, max_cells=None, tails=True, band=None):
+    '''
+    scores: (l1, l2) substitution scores (array, SubstitutionScores or ProfileScores)
+    edges (tuple): first row of dp and I1, first column of dp and I2
+    gap_open (float): penalty for opening gaps
+    gap_extend (float): penalty for extending gaps
+    max_cells (int): size of the full DP matrices above which the linear-space mode is used,
+                     MAX_DP_CELLS by default
+    tails (bool): whether the traceback of the full matrices finishes along the first row or column
+    band (tuple): diagonals (k_lo, k_hi) to restrict the alignment to, see 'banded_wavefront'.
+                  The full alignment is used if the band covers half of the matrices or
+                  the banded path touches the edge of the band
+
+    The full matrices keep the historical traceback, which follows the direction of the dp values.
+    The linear-space mode follows the gap states, so it returns an optimal path for the same
+    score, not necessarily the same one, and no score matrix.
+
+    Returns a tuple of two arrays of aligned positions (-1 marks a gap), a score matrix
+    (None in the linear-space and banded modes) and a final score of the alignment
+    '''
+    l1, l2 = scores.shape
+    max_cells = MAX_DP_CELLS if max_cells is None else max_cells
+
+    if band is not None and l1 > 0 and l2 > 0 and 2 * (band[1] - band[0] + 2) < l2 + 1:
+        banded = banded_wavefront(scores, edges, band, gap_open, gap_extend, tails)
+        if banded is not None:
+            path1, path2, score = banded
+            return path1, path2, None, score
+
+    if (l1 + 1) * (l2 + 1) <= max_cells or l1 == 0 or l2 == 0:
+        dp, I1, I2 = init_matrices(edges)
+        traceback = affine_wavefront(scores, dp, I1, I2, gap_open, gap_extend)
+        path1, path2 = traceback_indices(traceback, l1, l2, tails)
+        return path1, path2, dp, dp[l1][l2]
+
+    score, _ = _forward_scan(scores, (0, 0), edges, gap_open, gap_extend)
+    moves = _linear_space_moves(scores, (0, 0), edges, gap_open, gap_extend, 0, max_cells)
+    path1, path2 = _moves_to_path(moves)
+
+    return path1, path2, None, score
+
+
+def _match_scores(seq1, seq2, match, mismatch, matrix=None):
+    '''
+    Returns the scores of the two sequences (SubstitutionScores) from the substitution
+    matrix indexed by alphabet codes, by default the match/mismatch matrix
+    '''
+    matrix = scoring.match_matrix(match, mismatch) if matrix is None else matrix
+
+    return SubstitutionScores(as_codes(seq1), as_codes(seq2), matrix)
+
+
+def _apply_path(seq, path):
+    if isinstance(seq, str):
+        return ''.join(seq[idx] if idx >= 0 else '-' for idx in path)
+
+    aligned = np.full(len(path), GAP, dtype=np.uint8)
+    aligned[path >= 0] = np.asarray(seq)[path[path >= 0]]
+    return aligned
+
+
+def batch_wavefront(query, targets, lengths, matrix, edges, gap_open=1.0, gap_extend=0.5):
+    '''
+    query (np.ndarray): codes of the query sequence
+    targets (np.ndarray): (B, M) codes of the target sequences padded to a common length
+    lengths (np.ndarray): lengths of the targets
+    matrix (np.ndarray): substitution scores indexed by codes
+    edges (list): edges of every query-target pair (see 'affine_edges', 'linear_edges')
+    gap_open (float): penalty for opening gaps
+    gap_extend (float): penalty for extending gaps
+
+    Runs the recursion of 'affine_wavefront' for the query against all targets at once:
+    the anti-diagonals are kept as (l1 + 1, B) arrays indexed by the query position with
+    the batch as the innermost dimension. Cells beyond the end of a shorter target are
+    computed on the padding but never feed the cells of that target.
+
+    Returns the scores of the alignments of the query with every target
+    '''
+    l1, (batch, width) = len(query), targets.shape
+    top_dp, top_gap = np.full((width + 1, batch), -np.inf), np.full((width + 1, batch), -np.inf)
+    for b, (edge_dp, edge_gap, _, _) in enumerate(edges):
+        top_dp[:lengths[b] + 1, b], top_gap[:lengths[b] + 1, b] = edge_dp, edge_gap
+    left_dp, left_gap = edges[0][2], edges[0][3]
+
+    if l1 == 0:
+        return top_dp[lengths, np.arange(batch)]
+    if width == 0:
+        return np.full(batch, left_dp[l1])
+
+    result = np.full(batch, np.nan)
+    metrics.count('dp_cells', l1 * width * batch)
+    dp = [np.full((l1 + 1, batch), -np.inf) for _ in range(3)]
+    I1 = [np.full((l1 + 1, batch), -np.inf) for _ in range(2)]
+    I2 = [np.full((l1 + 1, batch), -np.inf) for _ in range(2)]
+    dp[0][0] = top_dp[0]
+    dp[1][0], I1[1][0] = top_dp[1], top_gap[1]
+    dp[1][1], I2[1][1] = left_dp[1], left_gap[1]
+    result[lengths == 0] = left_dp[l1]
+    ends = l1 + lengths
+
+    for d in range(2, l1 + width + 1):
+        lo, hi = max(1, d - width), min(l1, d - 1)
+        rows = np.arange(lo, hi + 1)
+        prev2, prev, new = dp[(d - 2) % 3], dp[(d - 1) % 3], dp[d % 3]
+        prev_I1, new_I1 = I1[(d - 1) % 2], I1[d % 2]
+        prev_I2, new_I2 = I2[(d - 1) % 2], I2[d % 2]
+
+        if lo <= hi:
+            diag_score = prev2[lo - 1:hi] + matrix[query[rows - 1][:, None], targets[:, d - rows - 1].T]
+            gap1 = np.maximum(prev_I1[lo - 1:hi] - gap_extend, prev[lo - 1:hi] - gap_open)
+            gap2 = np.maximum(prev_I2[lo:hi + 1] - gap_extend, prev[lo:hi + 1] - gap_open)
+            new_I1[lo:hi + 1] = gap1
+            new_I2[lo:hi + 1] = gap2
+            new[lo:hi + 1] = np.maximum(np.maximum(diag_score, gap1), gap2)
+
+        if d <= width:
+            new[0], new_I1[0] = top_dp[d], top_gap[d]
+        if d <= l1:
+            new[d], new_I2[d] = left_dp[d], left_gap[d]
+
+        done = ends == d
+        result[done] = new[l1, done]
+
+    return result
+
+
+def _batch_codes(targets):
+    '''
+    Returns (B, M) alphabet codes of the targets padded with gaps and their lengths
+    '''
+    lengths = np.array([len(seq) for seq in targets], dtype=np.int64)
+    padded = np.full((len(targets), int(lengths.max(initial=0))), GAP, dtype=np.uint8)
+    padded[np.arange(padded.shape[1]) < lengths[:, None]] = np.concatenate([as_codes(seq) for seq in targets])
+
+    return padded, lengths
+
+
+def needleman_wunsch_scores(query, targets, match=1, mismatch=1, gap=1, gap_extend=None, matrix=None):
+    '''
+    query (str | np.ndarray): sequence aligned with all targets
+    targets (list): sequences (strings or arrays of alphabet codes)
+    match (int): score for matching characters
+    mismatch (int): penalty for mismatching characters
+    gap (int): penalty for gaps (for opening gaps if gap_extend is given)
+    gap_extend (float): penalty for extending gaps, None for the linear gap model
+    matrix (np.ndarray): substitution matrix indexed by alphabet codes (see 'scoring'),
+                         replaces match and mismatch
+
+    Aligns the query with all targets at once without a traceback, see 'batch_wavefront'.
+
+    Returns the scores of 'needleman_wunsch' (or 'needleman_wunsch_affine' if gap_extend
+    is given) of the query with every target
+    '''
+    if not len(targets):
+        return np.empty(0)
+
+    padded, lengths = _batch_codes(targets)
+    matrix = scoring.match_matrix(match, mismatch) if matrix is None else matrix
+    if gap_extend is None:
+        edges = [linear_edges(len(query), length, gap) for length in lengths]
+        gap_open, gap_extend = gap, gap
+    else:
+        edges = [affine_edges(len(query), length, gap, gap_extend) for length in lengths]
+        gap_open = gap
+
+    return batch_wavefront(as_codes(query), padded, lengths, matrix, edges, gap_open, gap_extend)
+
+
+def _rolling_score(seq1, seq2, matrix, edges, gap_open, gap_extend):
+    '''
+    Returns the final score of the alignment from '_forward_scan' without a traceback.
+    The matrices are transposed if needed so that the scan keeps anti-diagonals of the
+    shorter sequence, the memory is O(min(l1, l2))
+    '''
+    codes1, codes2 = as_codes(seq1), as_codes(seq2)
+    if len(codes1) > len(codes2):
+        codes1, codes2, matrix = codes2, codes1, matrix.T
+        edges = (edges[2], edges[3], edges[0], edges[1])
+    if len(codes1) == 0:
+        return edges[0][len(codes2)]
+
+    score, _ = _forward_scan(SubstitutionScores(codes1, codes2, matrix), (0, 0), edges, gap_open, gap_extend)
+    return score
+
+
+def needleman_wunsch_score(seq1, seq2, match=1, mismatch=1, gap=1, matrix=None):
+    '''
+    seq1 (str | np.ndarray): first sequence to align, a string or an array of alphabet codes
+    seq2 (str | np.ndarray): second sequence to align, a string or an array of alphabet codes
+    match (int): score for matching characters
+    mismatch (int): penalty for mismatching characters
+    gap (int): penalty for gaps
+    matrix (np.ndarray): substitution matrix indexed by alphabet codes (see 'scoring'),
+                         replaces match and mismatch
+
+    Returns the score of 'needleman_wunsch' without building the alignment
+    '''
+    matrix = scoring.match_matrix(match, mismatch) if matrix is None else matrix
+    edges = linear_edges(len(seq1), len(seq2), gap)
+
+    return _rolling_score(seq1, seq2, matrix, edges, gap, gap)
+
+
+def needleman_wunsch_affine_score(seq1, seq2, match=1, mismatch=1, gap_open=1, gap_extend=0.5, matrix=None):
+    '''
+    seq1 (str | np.ndarray): first sequence to align, a string or an array of alphabet codes
+    seq2 (str | np.ndarray): second sequence to align, a string or an array of alphabet codes
+    match (int): score for matching characters
+    mismatch (int): penalty for mismatching characters
+    gap_open (int): penalty for opening gaps
+    gap_extend (float): penalty for extending gaps
+    matrix (np.ndarray): substitution matrix indexed by alphabet codes (see 'scoring'),
+                         replaces match and mismatch
+
+    Returns the score of 'needleman_wunsch_affine' without building the alignment
+    '''
+    matrix = scoring.match_matrix(match, mismatch) if matrix is None else matrix
+    edges = affine_edges(len(seq1), len(seq2), gap_open, gap_extend)
+
+    return _rolling_score(seq1, seq2, matrix, edges, gap_open, gap_extend)
+
+
+def needleman_wunsch(seq1, seq2, match=1, mismatch=1, gap=1, max_cells=None, band=None, matrix=None):
+    '''
+    seq1 (str | np.ndarray): first sequence to align, a string or an array of alphabet codes
+    seq2 (str | np.ndarray): first sequence to align, a string or an array of alphabet codes
+    match (int): score for matching characters
+    mismatch (int): penalty for mismatching characters
+    gap (int): penalty for gaps
+    max_cells (int): size of the DP matrices above which the linear-space mode is used
+    band (int | str): half-width of the band of diagonals, 'auto' to estimate it from
+                      k-tuple hits, None for the full alignment (see 'band_limits')
+    matrix (np.ndarray): substitution matrix indexed by alphabet codes (see 'scoring'),
+                         replaces match and mismatch
+
+    Returns a tuple of two aligned sequences, a score matrix (None in the linear-space
+    and banded modes) and a final score of the alignment
+    '''
+    scores = _match_scores(seq1, seq2, match, mismatch, matrix)
+
+    path1, path2, dp, score = align(
+        scores=scores,
+        edges=linear_edges(len(seq1), len(seq2), gap),
+        gap_open=gap,
+        gap_extend=gap,
+        max_cells=max_cells,
+        tails=False,
+        band=band_limits(len(seq1), len(seq2), band, scores.codes1, scores.codes2),
+    )
+
+    return _apply_path(seq1, path1), _apply_path(seq2, path2), dp, score
+
+
+def needleman_wunsch_affine(
+    seq1, seq2, match=1, mismatch=1, gap_open=1, gap_extend=0.5, max_cells=None, band=None, matrix=None,
+):
+    '''
+    seq1 (str | np.ndarray): first sequence to align, a string or an array of alphabet codes
+    seq2 (str | np.ndarray): first sequence to align, a string or an array of alphabet codes
+    match (int): score for matching characters
+    mismatch (int): penalty for mismatching characters
+    gap_open (int): penalty for opening gaps
+    gap_extend (float): penalty for extending gaps
+    max_cells (int): size of the DP matrices above which the linear-space mode is used
+    band (int | str): half-width of the band of diagonals, 'auto' to estimate it from
+                      k-tuple hits, None for the full alignment (see 'band_limits')
+    matrix (np.ndarray): substitution matrix indexed by alphabet codes (see 'scoring'),
+                         replaces match and mismatch
+
+    Returns a tuple of two aligned sequences, a score matrix (None in the linear-space
+    and banded modes) and a final score of the alignment
+    '''
+    scores = _match_scores(seq1, seq2, match, mismatch, matrix)
+
+    path1, path2, dp, score = base_needleman_wunsch_affine(
+        scores=scores,
+        gap_open=gap_open,
+        gap_extend=gap_extend,
+        max_cells=max_cells,
+        band=band_limits(len(seq1), len(seq2), band, scores.codes1, scores.codes2),
+    )
+
+    return _apply_path(seq1, path1), _apply_path(seq2, path2), dp, score
+
+
+def base_needleman_wunsch_affine(
+    scores,
+    gap_open: float = 1.0,
+    gap_extend: float = 0.5,
+    max_cells: int = None,
+    band: tuple = None,
+):
+    '''
+    scores: precomputed (l1, l2) substitution score matrix, or SubstitutionScores / ProfileScores
+            evaluated on demand
+    gap_open (int): penalty for opening gaps
+    gap_extend (float): penalty for extending gaps
+    max_cells (int): size of the DP matrices above which the linear-space mode is used,
+                     MAX_DP_CELLS by default
+    band (tuple): diagonals (k_lo, k_hi) to restrict the alignment to, see 'band_limits'
+
+    Returns a tuple of two arrays of aligned positions (-1 marks a gap), a score matrix
+    (None in the linear-space and banded modes) and a final score of the alignment
+    '''
+
+    l1, l2 = scores.shape
+    return align(scores, affine_edges(l1, l2, gap_open, gap_extend), gap_open, gap_extend, max_cells, band=band)
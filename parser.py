@@ -13,6 +13,39 @@ class Args(typing.NamedTuple):
     match: float
     mismatch: float
     output: str
+    threads: int
+    distance: typing.Literal["nw", "ktuple"]
+    ktuple: int
+    tree: typing.Literal["upgma", "nj"]
+    guide_tree_in: str
+    guide_tree_out: str
+    cache_dir: str
+    memmap_dir: str
+    distance_dtype: typing.Literal["float32", "float64"]
+    add: str
+    format: typing.Literal["clustal", "fasta", "stockholm"]
+    band: typing.Union[int, str, None]
+    dedup: typing.Optional[float]
+    seq_weights: bool
+    metrics_json: str
+    checkpoint_dir: str
+    resume: bool
+
+
+def band_width(value):
+    if value == "auto":
+        return value
+    width = int(value)
+    if width < 1:
+        raise argparse.ArgumentTypeError("band width must be a positive integer or 'auto'")
+    return width
+
+
+def identity(value):
+    fraction = float(value)
+    if not 0 < fraction <= 1:
+        raise argparse.ArgumentTypeError("identity must be in (0, 1]")
+    return fraction
 
 
 def create_parser():
@@ -28,12 +61,52 @@ def create_parser():
     parser.add_argument("--match", type=float,  default=5,  help="Bonus for match (for DNA alignment)")
     parser.add_argument("--mismatch", type=float, default=4, help="Penalty for mismatch (for DNA alignment)")
     parser.add_argument("-o", "--output", type=str, default=None, help="File for writing the output" )
+    parser.add_argument("--format", type=str, choices=("clustal", "fasta", "stockholm"), default="clustal",
+                        help="Format of the output: {clustal, fasta, stockholm}")
+    parser.add_argument("--threads", type=int, default=1, help="Number of processes for the distance matrix and the progressive alignment")
+    parser.add_argument("--distance", type=str, choices=("nw", "ktuple"), default="nw",
+                        help="Distances for the guide tree: {nw, ktuple}")
+    parser.add_argument("--ktuple", type=int, default=None,
+                        help="Length of k-tuples for --distance ktuple (by default 4 for DNA, 2 for protein)")
+    parser.add_argument("--tree", type=str, choices=("upgma", "nj"), default="upgma",
+                        help="Method for building the guide tree: {upgma, nj}")
+    parser.add_argument("--guide-tree-in", type=str, default=None,
+                        help="File with a guide tree in Newick format, skips the distances and the tree building")
+    parser.add_argument("--guide-tree-out", type=str, default=None,
+                        help="File for writing the guide tree in Newick format")
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help="Directory for the cache of pairwise alignment scores")
+    parser.add_argument("--memmap-dir", type=str, default=None,
+                        help="Directory for a memory-mapped file with the distance matrix (kept in memory by default)")
+    parser.add_argument("--distance-dtype", type=str, choices=("float32", "float64"), default="float32",
+                        help="Type of the distance matrix entries for UPGMA: {float32, float64}")
+    parser.add_argument("--band", type=band_width, default=None,
+                        help="Banded pairwise and profile alignments: half-width of the band or 'auto'")
+    parser.add_argument("--no-seq-weights", dest="seq_weights", action="store_false",
+                        help="Count all sequences equally in the profiles instead of weighting them by the guide tree")
+    parser.add_argument("--dedup", type=identity, nargs="?", const=1.0, default=None,
+                        help="Align duplicate sequences once: exact duplicates, or sequences of the same length "
+                             "with at least the given fraction of identical positions")
+    parser.add_argument("--add", type=str, default=None,
+                        help="FASTA file with sequences to add to the alignment given with -f (requires -a aligned)")
+    parser.add_argument("--checkpoint-dir", type=str, default=None,
+                        help="Directory for saving the distance matrix, the guide tree and the aligned subtrees")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the run saved in --checkpoint-dir instead of starting over")
+    parser.add_argument("--metrics-json", type=str, default=None,
+                        help="File for writing the timings, work counters and peak memory of every stage as JSON")
     return parser
 
 
-def parse_args() -> Args:
+def parse_args(argv=None) -> Args:
     parser = create_parser()
-    args = parser.parse_args(sys.argv[1:])
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if args.add is not None and args.alignment_mode != "aligned":
+        parser.error("--add requires an existing alignment: use -a aligned")
+    if args.dedup is not None and args.guide_tree_in is not None:
+        parser.error("--dedup cannot be combined with --guide-tree-in")
+    if args.resume and args.checkpoint_dir is None:
+        parser.error("--resume requires --checkpoint-dir")
 
     return Args(
         filename=args.filename,
@@ -43,7 +116,24 @@ def parse_args() -> Args:
         molecule=args.molecule,
         match=args.match,
         mismatch=args.mismatch,
-        output=args.output
+        output=args.output,
+        threads=args.threads,
+        distance=args.distance,
+        ktuple=args.ktuple,
+        tree=args.tree,
+        guide_tree_in=args.guide_tree_in,
+        guide_tree_out=args.guide_tree_out,
+        cache_dir=args.cache_dir,
+        memmap_dir=args.memmap_dir,
+        distance_dtype=args.distance_dtype,
+        add=args.add,
+        format=args.format,
+        band=args.band,
+        dedup=args.dedup,
+        seq_weights=args.seq_weights,
+        metrics_json=args.metrics_json,
+        checkpoint_dir=args.checkpoint_dir,
+        resume=args.resume,
     )
 
 
@@ -1,82 +1,326 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
 import numpy as np
 
-from upgma import UPGMA_Node
-from pairwise_alignment import base_needleman_wunsch_affine
+import alphabet
+import metrics
+import scoring
+from upgma import UPGMA_Node, leaves, postorder
+from pairwise_alignment import ProfileScores, band_limits, base_needleman_wunsch_affine
 
 class Cluster:
-    def __init__(self, seqs: list[str]):
+    def __init__(self, seqs: np.ndarray, weights: np.ndarray = None):
+        """
+        Args:
+            seqs (np.ndarray): (N, L) uint8 matrix of alphabet codes, one aligned sequence per row
+            weights (np.ndarray): weight of every row in the profile, 1 for all rows if None
+        """
         self.seqs = seqs
+        self.weights = weights
+
+    @property
+    def row_weights(self) -> np.ndarray:
+        return np.ones(self.seqs.shape[0]) if self.weights is None else self.weights
+
+    def insert_gaps(self, path: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            path (np.ndarray): aligned positions of the cluster columns, -1 marks a gap
+        Returns:
+            (N, len(path)) matrix of the cluster sequences with gap columns inserted
+        """
+        aligned = np.full((self.seqs.shape[0], len(path)), alphabet.GAP, dtype=np.uint8)
+        aligned[:, path >= 0] = self.seqs
+        return aligned
+
+
+def encode_weight_matrix(weight_matrix: dict | np.ndarray) -> np.ndarray:
+    """
+    Args:
+        weight_matrix (dict | np.ndarray): substitution scores keyed by pairs of residues,
+                                           or already a matrix indexed by alphabet codes
+    Returns:
+        the scores as a dense (A, A) matrix indexed by alphabet codes,
+        pairs missing from weight_matrix are NaN
+    """
+    if isinstance(weight_matrix, dict):
+        return scoring.from_pairs(weight_matrix)
+    return weight_matrix
+
+
+class Profile:
+    """
+    Per-column residue counts (L, A) of an aligned cluster, weighted by the row weights
+    """
+    def __init__(self, counts: np.ndarray):
+        self.counts = counts
+
+    @classmethod
+    def from_cluster(cls, cluster: Cluster) -> "Profile":
+        length = cluster.seqs.shape[1]
+        offsets = cluster.seqs + np.arange(length) * alphabet.SIZE
+        weights = None if cluster.weights is None else np.repeat(cluster.weights, length)
+        counts = np.bincount(offsets.ravel(), weights=weights, minlength=length * alphabet.SIZE)
+
+        return cls(counts=counts.reshape(length, alphabet.SIZE))
+
+    @property
+    def frequencies(self) -> np.ndarray:
+        return self.counts / self.counts.sum(axis=1, keepdims=True)
+
+    @property
+    def consensus(self) -> np.ndarray:
+        """
+        Most frequent residue of every column, -1 for the columns with gaps only
+        """
+        residues = self.counts[:, alphabet.GAP + 1:]
+        return np.where(residues.any(axis=1), residues.argmax(axis=1) + alphabet.GAP + 1, -1)
+
+
+def profile_scores(first: Profile, second: Profile, weight_matrix: np.ndarray) -> ProfileScores:
+    """
+    Args:
+        first (Profile): profile of the first cluster
+        second (Profile): profile of the second cluster
+        weight_matrix (np.ndarray): encoded substitution matrix
+    Returns:
+        (L1, L2) mean substitution scores over all pairs of sequences of the two clusters,
+        F1 W F2^T, evaluated by the aligner only for the cells it needs
+    """
+    used1, used2 = first.counts.any(axis=0), second.counts.any(axis=0)
+    if np.isnan(weight_matrix[np.ix_(used1, used2)]).any():
+        raise KeyError('Weight matrix has no score for some pair of residues')
+
+    matrix = np.nan_to_num(weight_matrix, nan=0.0)
+    return ProfileScores(first.frequencies @ matrix, second.frequencies)
 
 
 def cluster_alignment(
     first: Cluster,
     second: Cluster,
-    weight_matrix: dict,
+    weight_matrix: np.ndarray | dict,
     gap_open: float,
     gap_extend: float,
+    band: int | str = None,
 ) -> Cluster:
-    def weight_gen(i: int, j: int) -> float:
-        return np.array([
-            weight_matrix[(seq1[i], seq2[j])]
-            for seq1 in first.seqs
-            for seq2 in second.seqs
-        ]).mean()
+    """
+    Args:
+        band (int | str): half-width of the band of diagonals or 'auto' (estimated from the
+                          consensus sequences) for the banded alignment of the profiles
+    Returns:
+        cluster of the sequences of both clusters aligned to each other
+    """
+    weight_matrix = encode_weight_matrix(weight_matrix)
 
+    first_profile, second_profile = Profile.from_cluster(first), Profile.from_cluster(second)
+    scores = profile_scores(first_profile, second_profile, weight_matrix)
 
     align1, align2, _, _ = base_needleman_wunsch_affine(
-        seq1_len=len(first.seqs[0]),
-        seq2_len=len(second.seqs[0]),
-        weight_gen=weight_gen,
+        scores=scores,
         gap_open=gap_open,
         gap_extend=gap_extend,
+        band=band_limits(*scores.shape, band, first_profile.consensus, second_profile.consensus),
     )
 
-    return Cluster(
-        seqs=[
-            "".join([
-                seq1[idx] if isinstance(idx, int) else '-'
-                for idx in align1
-            ])
-            for seq1 in first.seqs
-        ] + [
-            "".join([
-                seq2[idx] if isinstance(idx, int) else '-'
-                for idx in align2
-            ])
-            for seq2 in second.seqs
-        ]
-    )
+    weights = None
+    if first.weights is not None or second.weights is not None:
+        weights = np.concatenate([first.row_weights, second.row_weights])
+    return Cluster(seqs=np.vstack([first.insert_gaps(align1), second.insert_gaps(align2)]), weights=weights)
+
+
 
 
+_worker_state = {}
+
+
+def _init_worker(weight_matrix, gap_open, gap_extend, band=None):
+    _worker_state.update(weight_matrix=weight_matrix, gap_open=gap_open, gap_extend=gap_extend, band=band)
+
+
+def _merge(first: np.ndarray, second: np.ndarray, first_weights=None, second_weights=None) -> np.ndarray:
+    """
+    Aligns two profiles given as code matrices (and the weights of their rows),
+    runs in the worker processes
+    """
+    metrics.count('merges')
+    return cluster_alignment(
+        first=Cluster(seqs=first, weights=first_weights),
+        second=Cluster(seqs=second, weights=second_weights),
+        weight_matrix=_worker_state['weight_matrix'],
+        gap_open=_worker_state['gap_open'],
+        gap_extend=_worker_state['gap_extend'],
+        band=_worker_state['band'],
+    ).seqs
 
 
 def progressive_alignment(
         sequences: list[str],
         guide_tree_root: UPGMA_Node,
-        weight_matrix: dict,
+        weight_matrix: np.ndarray | dict,
         gap_open: float = 1.0,
         gap_extend: float = 0.5,
+        workers: int = 1,
+        band: int | str = None,
+        checkpoint=None,
+        weights: np.ndarray = None,
 ):
     """
     Args:
-        sequences (list): list of sequences
+        sequences (list): list of sequences (strings or arrays of alphabet codes)
         guide_tree_root (UPGMA_Node): root node of the guide tree
-        weight_matrix (dict): if weight matrix is None, aligns DNA sequences
+        weight_matrix (np.ndarray | dict): substitution matrix indexed by alphabet codes (see 'scoring')
+        workers (int): number of processes merging independent subtrees at the same time
+        band (int | str): band of the profile alignments, see 'cluster_alignment'
+        checkpoint (Checkpoint): checkpoint the aligned subtrees are saved to, subtrees
+                                 saved by an earlier run are not aligned again
+        weights (np.ndarray): weight of every sequence in the profile counts (e.g. the number
+                              of duplicates it stands for), 1 for all sequences if None
     Returns:
-        aligned sequences (list[str])
+        aligned sequences as a (N, L) uint8 matrix of alphabet codes,
+        rows follow the leaf order of the guide tree
     """
+    weight_matrix = encode_weight_matrix(weight_matrix)
+
+    nodes = list(postorder(guide_tree_root))
+    index = {id(node): k for k, node in enumerate(nodes)}
+    parent = {index[id(child)]: k for k, node in enumerate(nodes) for child in node.children}
+    profiles = {
+        k: alphabet.as_codes(sequences[node.id])[None, :]
+        for k, node in enumerate(nodes) if not node.children
+    }
+
+    def children(k):
+        return [index[id(child)] for child in nodes[k].children]
+
+    def merge_args(k):
+        # profiles of the children and the weights of their rows (in the leaf order)
+        first, second = children(k)
+        if weights is None:
+            return profiles.pop(first), profiles.pop(second)
+        return (profiles.pop(first), profiles.pop(second),
+                weights[slice(*spans[first])], weights[slice(*spans[second])])
+
+    if weights is not None:
+        # the leaves of every subtree are a contiguous range of the leaf order,
+        # so the weights of its rows are a slice of the weights in that order
+        spans = {}
+        order = []
+        for k, node in enumerate(nodes):
+            if node.children:
+                spans[k] = (spans[index[id(node.children[0])]][0], spans[index[id(node.children[-1])]][1])
+            else:
+                spans[k] = (len(order), len(order) + 1)
+                order.append(node.id)
+        weights = np.asarray(weights, dtype=np.float64)[order]
+
+    # subtrees below a saved profile are done, saved profiles inside them are stale
+    done = set()
+    saved = {}
+    if checkpoint is not None:
+        on_disk = checkpoint.profiles()
+        for k in reversed(range(len(nodes))):
+            if k in parent and parent[k] in done:
+                done.add(k)
+                profiles.pop(k, None)
+                if k in on_disk:
+                    checkpoint.remove_profile(k)
+            elif k in on_disk:
+                done.add(k)
+                profiles[k] = checkpoint.load_profile(k)
+                saved[k] = {k}
+
+    def finish(k, profile):
+        # saved profiles inside the subtree are passed up until the subtree itself is saved
+        profiles[k] = profile
+        progress.update()
+        if checkpoint is not None:
+            below = set().union(*(saved.pop(child, ()) for child in children(k)))
+            if checkpoint.due() or k == len(nodes) - 1:
+                checkpoint.save_profile(k, profile, replaces=below)
+                below = {k}
+            saved[k] = below
+
+    merges = [k for k, node in enumerate(nodes) if node.children and k not in done]
+    progress = metrics.Progress(len(merges), 'Aligning')
+    if workers <= 1:
+        _init_worker(weight_matrix, gap_open, gap_extend, band)
+        for k in merges:
+            finish(k, _merge(*merge_args(k)))
+        _worker_state.clear()
+        return profiles[len(nodes) - 1]
+
+    # merges are submitted bottom-up as soon as both subtrees are aligned,
+    # profiles travel between the processes as uint8 code matrices
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(weight_matrix, gap_open, gap_extend, band),
+    ) as pool:
+        running = {}
+
+        def submit(k):
+            running[pool.submit(metrics.collect, _merge, *merge_args(k))] = k
 
-    def inner(node: UPGMA_Node):
-        if not node.children:
-            return Cluster(seqs=[sequences[node.id]])
+        for k in merges:
+            if all(child in profiles for child in children(k)):
+                submit(k)
 
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                k = running.pop(future)
+                profile, deltas = future.result()
+                metrics.merge(deltas)
+                finish(k, profile)
+                if k in parent and all(child in profiles for child in children(parent[k])):
+                    submit(parent[k])
 
-        return cluster_alignment(
-            first=inner(node=node.children[0]),
-            second=inner(node=node.children[1]),
-            weight_matrix=weight_matrix,
-            gap_open=gap_open,
-            gap_extend=gap_extend,
-        )
+    return profiles[len(nodes) - 1]
+
+
+def add_to_alignment(
+        alignment: list[str],
+        sequences: list[str],
+        guide_tree_root: UPGMA_Node,
+        weight_matrix: np.ndarray | dict,
+        gap_open: float = 1.0,
+        gap_extend: float = 0.5,
+        workers: int = 1,
+        band: int | str = None,
+        checkpoint=None,
+        weights: np.ndarray = None,
+):
+    """
+    Args:
+        alignment (list): aligned sequences of the existing alignment
+        sequences (list): list of new sequences
+        guide_tree_root (UPGMA_Node): root node of the guide tree of the new sequences
+        weight_matrix (np.ndarray | dict): substitution matrix indexed by alphabet codes (see 'scoring')
+        workers (int): number of processes merging independent subtrees at the same time
+        band (int | str): band of the profile alignments, see 'cluster_alignment'
+        checkpoint (Checkpoint): checkpoint of the alignment of the new sequences, see 'progressive_alignment'
+        weights (np.ndarray): weights of the new sequences, see 'progressive_alignment'
+    Returns:
+        (N + M, L) uint8 matrix of alphabet codes: the rows of the existing alignment
+        followed by the new sequences in the leaf order of their guide tree. The existing
+        alignment is kept as a fixed profile, only gap columns are inserted into it
+    """
+    if len({len(seq) for seq in alignment}) > 1:
+        raise ValueError('Sequences of the existing alignment have different lengths')
+
+    fixed = Cluster(seqs=np.vstack([alphabet.as_codes(seq) for seq in alignment]))
+    added = progressive_alignment(
+        sequences=sequences,
+        guide_tree_root=guide_tree_root,
+        weight_matrix=weight_matrix,
+        gap_open=gap_open,
+        gap_extend=gap_extend,
+        workers=workers,
+        band=band,
+        checkpoint=checkpoint,
+        weights=weights,
+    )
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)[leaves(guide_tree_root)]
 
-    return inner(node=guide_tree_root).seqs
\ No newline at end of file
+    return cluster_alignment(fixed, Cluster(seqs=added, weights=weights), weight_matrix, gap_open, gap_extend, band).seqs
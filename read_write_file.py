@@ -1,66 +1,250 @@
+import gzip
+import mmap
+import os
+import sys
 
-from Bio import SeqIO
+import numpy as np
 
-def read_seqs(f, alignment_mode):
+import metrics
+from alphabet import GAP, as_codes, decode_rows, encode, encode_bytes
+from newick import from_newick, to_newick
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_WHITESPACE = b' \t\r\n\v\f'
+_CLUSTAL_HEADERS = (b'CLUSTAL', b'PROBCONS', b'MUSCLE', b'MSAPROBS', b'Kalign')
+
+
+def _open(f, gzipped):
+    return gzip.open(f, 'rb') if gzipped else open(f, 'rb')
+
+
+def _first_line(f, gzipped):
+    with _open(f, gzipped) as file:
+        for line in file:
+            if line.strip():
+                return line.lstrip()
+    return b''
+
+
+def _name(header):
+    fields = header.split(maxsplit=1)
+    return fields[0].decode('utf-8', errors='replace') if fields else ''
+
+
+def _fasta_mmap(f):
+    '''
+    Yields (name, codes) of the records of a plain FASTA file, the file is memory-mapped
+    and every record is cut out and encoded with a few whole-buffer operations
+    '''
+    if os.path.getsize(f) == 0:
+        return
+    with open(f, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = data.find(b'>')
+        while start != -1:
+            header_end = data.find(b'\n', start)
+            header_end = len(data) if header_end == -1 else header_end
+            end = data.find(b'\n>', header_end)
+            body = data[header_end:len(data) if end == -1 else end]
+            yield _name(data[start + 1:header_end]), encode_bytes(body.translate(None, _WHITESPACE))
+            start = -1 if end == -1 else end + 1
+
+
+def _fasta_lines(lines):
+    '''
+    Yields (name, codes) of the FASTA records in an iterable of lines (bytes)
+    '''
+    name, chunks = None, []
+    for line in lines:
+        if line.startswith(b'>'):
+            if name is not None:
+                yield name, encode_bytes(b''.join(chunks))
+            name, chunks = _name(line[1:]), []
+        elif name is not None:
+            chunks.append(line.translate(None, _WHITESPACE))
+    if name is not None:
+        yield name, encode_bytes(b''.join(chunks))
+
+
+def _clustal_lines(lines, keep_gaps):
+    '''
+    Yields (name, codes) of the sequences of a Clustal alignment in an iterable of lines (bytes).
+    Blocks are collected per name, so the sequences are yielded once the input is read
+    '''
+    blocks = {}
+    for line in lines:
+        if line.startswith(_CLUSTAL_HEADERS) or not line.strip() or line[:1].isspace():
+            continue
+        fields = line.split()
+        if len(fields) >= 2:
+            blocks.setdefault(fields[0], []).append(fields[1])
+
+    for name, chunks in blocks.items():
+        codes = encode_bytes(b''.join(chunks))
+        yield name.decode('utf-8', errors='replace'), codes if keep_gaps else codes[codes != GAP]
+
+
+def _biopython(f, gzipped, fmt, keep_gaps):
+    '''
+    Yields (name, codes) of the records of any format Biopython can read, used only
+    for the inputs the built-in tokenizers do not recognise
+    '''
+    import io
+    from Bio import SeqIO
+
+    with _open(f, gzipped) as file:
+        for record in SeqIO.parse(io.TextIOWrapper(file, encoding='utf-8'), fmt):
+            sequence = str(record.seq)
+            yield record.id, encode(sequence if keep_gaps or fmt == 'fasta' else sequence.replace('-', ''))
+
+
+def iter_seqs(f, alignment_mode, keep_gaps=False):
+    '''
+    f (str): an input filename, plain or gzip-compressed
+    alignment_mode {unaligned, aligned}: FASTA sequences or a Clustal alignment
+    keep_gaps (bool): whether to keep the gaps of aligned sequences
+
+    Yields (name, codes) pairs, codes is the sequence as an array of alphabet codes.
+    FASTA and Clustal files are read by built-in tokenizers (plain FASTA files are
+    memory-mapped), Biopython is imported only for other inputs
+    '''
+    with open(f, 'rb') as file:
+        gzipped = file.read(2) == _GZIP_MAGIC
+    first = _first_line(f, gzipped)
+    metrics.count('bytes_read', os.path.getsize(f))
+
+    if alignment_mode == 'unaligned' and first.startswith(b'>'):
+        if gzipped:
+            with gzip.open(f, 'rb') as file:
+                yield from _fasta_lines(file)
+        else:
+            yield from _fasta_mmap(f)
+    elif alignment_mode == 'aligned' and first.startswith(_CLUSTAL_HEADERS):
+        with _open(f, gzipped) as file:
+            yield from _clustal_lines(file, keep_gaps)
+    elif first:
+        yield from _biopython(f, gzipped, 'fasta' if alignment_mode == 'unaligned' else 'clustal', keep_gaps)
+
+
+def read_seqs(f, alignment_mode, keep_gaps=False):
     '''
     f (str): an input filename
     alignment_mode {unaligned, aligned}: whether sequences need to be 
                                         preprocessed before alignment
+    keep_gaps (bool): whether to keep the gaps of aligned sequences
+
+    Returns sequences (arrays of alphabet codes) and their names from the original file
+    '''
+    seqs = []
+    names = []
+    for name, sequence in iter_seqs(f, alignment_mode, keep_gaps):
+        seqs.append(sequence)
+        names.append(name)
 
-    Returns sequences and their names from the original file
-    '''
-    if alignment_mode == 'unaligned':
-        fasta_sequences = SeqIO.parse(open(f), 'fasta')
-        seqs = []
-        names = []
-        for fasta in fasta_sequences:
-            name, sequence = fasta.id, str(fasta.seq)
-            seqs.append(sequence)
-            names.append(name)
-        
-    else:
-        clustal_sequences = SeqIO.parse(open(f), 'clustal')
-        seqs = []
-        names = []
-        for seq in clustal_sequences:
-            name, sequence = seq.id, str(seq.seq).replace('-','')
-            seqs.append(sequence)
-            names.append(name)
-        
     return seqs, names
 
 
-def fasta_to_clustal(ids, names, sequences, output, line_length=60):
+def read_tree(f, names):
+    '''
+    f (str): a file with the guide tree in Newick format
+    names (list): names of sequences from the original file
+
+    Returns the root of the guide tree
+    '''
+    with open(f, encoding="utf-8") as file:
+        return from_newick(file.read(), names)
+
+
+def write_tree(f, root, names):
+    '''
+    f (str): a file for writing the guide tree in Newick format
+    root (UPGMA_Node): root of the guide tree
+    names (list): names of sequences from the original file
+    '''
+    with open(f, "w", encoding="utf-8") as file:
+        file.write(to_newick(root, names) + "\n")
+
+
+def conservation_line(codes):
+    '''
+    codes (np.ndarray): (N, L) matrix of alphabet codes
+
+    Returns the conservation line of the alignment: '*' for columns with a single character
+    '''
+    conserved = (codes == codes[:1]).all(axis=0)
+    return np.where(conserved, ord('*'), ord(' ')).astype(np.uint8).tobytes().decode('ascii')
+
+
+def _clustal(labels, rows, codes, width, line_length):
+    consensus = conservation_line(codes)
+    labels = [label.ljust(width) for label in labels]
+    parts = ["CLUSTAL multiple sequence alignment\n\n"]
+    for i in range(0, codes.shape[1], line_length):
+        for label, row in zip(labels, rows):
+            parts += (label, row[i:i + line_length], "\n")
+        parts += (" " * width, consensus[i:i + line_length], "\n\n")
+    return parts
+
+
+def _fasta(labels, rows, codes, width, line_length):
+    parts = []
+    for label, row in zip(labels, rows):
+        parts += (">", label, "\n")
+        for i in range(0, len(row), line_length):
+            parts += (row[i:i + line_length], "\n")
+    return parts
+
+
+def _stockholm(labels, rows, codes, width, line_length):
+    labels = [label.ljust(width) for label in labels]
+    parts = ["# STOCKHOLM 1.0\n"]
+    for i in range(0, codes.shape[1], line_length):
+        parts.append("\n")
+        for label, row in zip(labels, rows):
+            parts += (label, row[i:i + line_length], "\n")
+    parts.append("//\n")
+    return parts
+
+
+FORMATS = {
+    'clustal': _clustal,
+    'fasta': _fasta,
+    'stockholm': _stockholm,
+}
+
+
+def write_alignment(ids, names, sequences, output, fmt='clustal', line_length=60):
     '''
     ids (list): list of ids derived from the guide tree
     names (list): names of sequences from the original file
-    sequences (list): list of aligned sequences
-    output(str):  file name for writing the output
+    sequences (np.ndarray | list): (N, L) matrix of alphabet codes or list of aligned sequences
+    output (str): file name for writing the output, stdout if None
+    fmt {clustal, fasta, stockholm}: output format
+    line_length (int): number of alignment columns per line
 
-    Prints in stdout the alignment in clustal format 
+    Writes the alignment in blocks of line_length columns with a single write
     '''
+    codes = sequences if isinstance(sequences, np.ndarray) else np.vstack([as_codes(seq) for seq in sequences])
+    rows = decode_rows(codes)
+    labels = [names[int(id)] for id in ids]
+    width = max(len(name) for name in names) + 5
+    text = "".join(FORMATS[fmt](labels, rows, codes, width, line_length))
+    metrics.count('bytes_written', len(text.encode("utf-8")))
 
-    consensus = []
-    for col in zip(*sequences):
-        char = {c for c in col}
-        if len(char) == 1:
-            consensus.append('*')
-        else:
-            consensus.append(' ')
-    
-    max_name = max(names, key=lambda x: len(x))
     if output is None:
-        print("CLUSTAL multiple sequence alignment\n")
-        for i in range(0, len(sequences[0]), line_length):
-            block_end = min(i+line_length, len(sequences[0]))
-            
-            for id, seq in zip(ids, sequences):
-                print(f"{names[int(id)].ljust(len(max_name) + 5)}{seq[i:block_end]}")
-            
-            print(f"{' '.ljust(len(max_name) + 5)}{''.join(consensus[i:block_end])}\n")
+        sys.stdout.write(text)
+        sys.stdout.flush()
     else:
         with open(output, "w", encoding="utf-8") as f:
-            f.write("CLUSTAL multiple sequence alignment\n\n")
-            for id, seq in zip(ids, sequences):
-                f.write(f"{names[int(id)].ljust(len(max_name) + 5)}{seq}\n")
-            f.write(f"{' '.ljust(len(max_name) + 5)}{''.join(consensus)}\n\n")
\ No newline at end of file
+            f.write(text)
+
+
+def fasta_to_clustal(ids, names, sequences, output, line_length=60):
+    '''
+    ids (list): list of ids derived from the guide tree
+    names (list): names of sequences from the original file
+    sequences (np.ndarray | list): (N, L) matrix of alphabet codes or list of aligned sequences
+    output(str):  file name for writing the output
+
+    Writes the alignment in clustal format to the file or to stdout
+    '''
+    write_alignment(ids, names, sequences, output, 'clustal', line_length)
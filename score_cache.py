@@ -0,0 +1,94 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+import alphabet
+
+_BATCH = 500
+
+
+class ScoreCache:
+    """
+    On-disk cache of pairwise alignment scores in a SQLite database.
+
+    Scores are addressed by a hash of the two sequences and the scoring parameters,
+    so the cache can be shared between runs on overlapping sets of sequences. The
+    pair is sorted before hashing (the scores are symmetric). When the cache holds
+    more than 'max_entries' scores, the least recently used ones are evicted.
+    """
+
+    def __init__(self, path, max_entries=1_000_000):
+        '''
+        path (str): database file, or a directory to keep 'scores.sqlite' in
+        max_entries (int): maximal number of cached scores
+        '''
+        if os.path.isdir(path):
+            path = os.path.join(path, 'scores.sqlite')
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS scores (key BLOB PRIMARY KEY, score REAL NOT NULL, used INTEGER NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS scores_used ON scores (used)')
+        self.connection.commit()
+
+    @staticmethod
+    def key(seq1, seq2, params) -> bytes:
+        '''
+        seq1, seq2 (str | np.ndarray): sequences (strings or arrays of alphabet codes)
+        params (tuple): scoring parameters, e.g. the method name and the penalties
+
+        Returns the cache key of the pair
+        '''
+        first, second = sorted((alphabet.as_codes(seq1).tobytes(), alphabet.as_codes(seq2).tobytes()))
+        digest = hashlib.blake2b(repr(params).encode('utf-8'), digest_size=16)
+        for seq in (first, second):
+            digest.update(len(seq).to_bytes(8, 'little'))
+            digest.update(seq)
+        return digest.digest()
+
+    def get_many(self, keys) -> dict:
+        '''
+        keys (iterable): cache keys
+
+        Returns a dict of the cached scores of the keys found in the cache
+        '''
+        keys = list(set(keys))
+        found = {}
+        now = time.time_ns()
+        with self.connection:
+            for start in range(0, len(keys), _BATCH):
+                batch = keys[start:start + _BATCH]
+                marks = ','.join('?' * len(batch))
+                found.update(self.connection.execute(
+                    f'SELECT key, score FROM scores WHERE key IN ({marks})', batch))
+                self.connection.execute(f'UPDATE scores SET used = ? WHERE key IN ({marks})', [now, *batch])
+        return found
+
+    def put_many(self, items):
+        '''
+        items (iterable): (key, score) pairs to store
+        '''
+        now = time.time_ns()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO scores (key, score, used) VALUES (?, ?, ?)',
+                ((key, float(score), now) for key, score in items))
+            excess = self.connection.execute('SELECT COUNT(*) FROM scores').fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    'DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY used LIMIT ?)', (excess,))
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,97 @@
+from functools import lru_cache
+
+import numpy as np
+
+import alphabet
+
+# bases matched by the IUPAC nucleotide codes
+IUPAC_BASES = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT',
+}
+
+
+def _frozen(matrix: np.ndarray) -> np.ndarray:
+    matrix.setflags(write=False)
+    return matrix
+
+
+def _codes(chars) -> np.ndarray:
+    return alphabet.encode(''.join(chars))
+
+
+@lru_cache(maxsize=None)
+def blosum_matrix(n: int = 62, offset: float = 5.0) -> np.ndarray:
+    '''
+    n (int): number of the BLOSUM matrix
+    offset (float): value added to all substitution scores
+
+    Returns the (SIZE, SIZE) float64 matrix indexed by alphabet codes: BLOSUM scores plus offset
+    for residues, 0 for pairs with gaps and NaN for residues the matrix has no scores for ('*')
+    '''
+    import blosum as bl
+
+    table = bl.BLOSUM(n, default=0)
+    acids = [acid for acid in table.keys() if acid != '*']
+    codes = _codes(acids)
+
+    matrix = np.full((alphabet.SIZE, alphabet.SIZE), np.nan, dtype=np.float64)
+    matrix[np.ix_(codes, codes)] = [[float(table[acid1][acid2]) + offset for acid2 in acids] for acid1 in acids]
+    matrix[codes, alphabet.GAP] = matrix[alphabet.GAP, codes] = 0.0
+    matrix[alphabet.GAP, alphabet.GAP] = 0.0
+
+    return _frozen(matrix)
+
+
+@lru_cache(maxsize=None)
+def dna_matrix(match: float = 5.0, mismatch: float = 4.0, gap: float = 1.0) -> np.ndarray:
+    '''
+    match (float): score for matching bases
+    mismatch (float): penalty for mismatching bases
+    gap (float): penalty for aligning a base with a gap
+
+    Returns the (SIZE, SIZE) float64 matrix indexed by alphabet codes. Ambiguity codes (IUPAC,
+    including N) score the average over all pairs of bases they stand for, pairs with a gap
+    score -gap, two gaps score 0 and letters that are not nucleotide codes are NaN
+    '''
+    codes = _codes(IUPAC_BASES)
+    bases = list(IUPAC_BASES.values())
+    scores = [
+        [np.mean([match if base1 == base2 else -mismatch for base1 in bases1 for base2 in bases2]) for bases2 in bases]
+        for bases1 in bases
+    ]
+
+    matrix = np.full((alphabet.SIZE, alphabet.SIZE), np.nan, dtype=np.float64)
+    matrix[np.ix_(codes, codes)] = scores
+    matrix[codes, alphabet.GAP] = matrix[alphabet.GAP, codes] = -gap
+    matrix[alphabet.GAP, alphabet.GAP] = 0.0
+
+    return _frozen(matrix)
+
+
+@lru_cache(maxsize=None)
+def match_matrix(match: float = 1.0, mismatch: float = 1.0) -> np.ndarray:
+    '''
+    match (float): score for matching characters
+    mismatch (float): penalty for mismatching characters
+
+    Returns the (SIZE, SIZE) float64 matrix indexed by alphabet codes with match on the
+    diagonal and -mismatch elsewhere, gaps included
+    '''
+    matrix = np.where(np.eye(alphabet.SIZE, dtype=bool), match, -mismatch).astype(np.float64)
+
+    return _frozen(matrix)
+
+
+def from_pairs(weights: dict) -> np.ndarray:
+    '''
+    weights (dict): substitution scores keyed by pairs of characters
+
+    Returns the (SIZE, SIZE) float64 matrix indexed by alphabet codes, NaN for missing pairs
+    '''
+    matrix = np.full((alphabet.SIZE, alphabet.SIZE), np.nan, dtype=np.float64)
+    for (char1, char2), weight in weights.items():
+        matrix[alphabet.encode(char1)[0], alphabet.encode(char2)[0]] = weight
+
+    return matrix
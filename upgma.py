@@ -1,83 +1,408 @@
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from itertools import combinations
 import numpy as np
 
+import metrics
+from condensed_matrix import CondensedMatrix
 from pairwise_alignment import (
     needleman_wunsch,
     needleman_wunsch_affine,
+    needleman_wunsch_affine_score,
+    needleman_wunsch_score,
+    needleman_wunsch_scores,
 )
 
+# number of targets aligned with a query at once by '_score_pairs', and the bound on
+# query length times batch size that keeps the batched anti-diagonals small
+BATCH_SIZE = 256
+BATCH_CELLS = 1 << 20
 
-def create_distance_matrix(sequences, match=1, mismatch=1, gap=1, gap_extend=None):
+_worker_state = {}
+
+
+def _init_worker(sequences, match, mismatch, gap, gap_extend, return_alignments, band=None):
+    _worker_state.update(
+        sequences=sequences,
+        match=match,
+        mismatch=mismatch,
+        gap=gap,
+        gap_extend=gap_extend,
+        return_alignments=return_alignments,
+        band=band,
+    )
+
+
+def _align_pairs(pairs):
+    """
+    pairs (list): list of (i, j) index pairs to align
+
+    Returns a list of (i, j, score, alignment) tuples, alignment is None unless requested
+    """
+    state = _worker_state
+    sequences = state['sequences']
+    results = []
+    for i, j in pairs:
+        if state['gap_extend'] is None:
+            align_seq1, align_seq2, _, score = needleman_wunsch(
+                sequences[i], sequences[j], state['match'], state['mismatch'], state['gap'], band=state['band'])
+        else:
+            align_seq1, align_seq2, _, score = needleman_wunsch_affine(
+                sequences[i], sequences[j], state['match'], state['mismatch'], state['gap'], state['gap_extend'],
+                band=state['band'])
+        alignment = (align_seq1, align_seq2) if state['return_alignments'] else None
+        results.append((i, j, score, alignment))
+
+    return results
+
+
+def _score_pairs(pairs):
+    """
+    pairs (list): list of (i, j) index pairs to align
+
+    Scores the pairs without alignments: the pairs are grouped by their first sequence and
+    each one is aligned with up to BATCH_SIZE second sequences of similar length at once.
+    Long sequences that leave room for a single target are scored pair by pair in memory
+    linear in the shorter sequence
+
+    Returns a list of (i, j, score, None) tuples
+    """
+    state = _worker_state
+    sequences = state['sequences']
+    targets = {}
+    for i, j in pairs:
+        targets.setdefault(i, []).append(j)
+
+    results = []
+    for i, group in targets.items():
+        group.sort(key=lambda j: len(sequences[j]))
+        batch_size = min(BATCH_SIZE, BATCH_CELLS // (len(sequences[i]) + 1))
+        if batch_size <= 1:
+            for j in group:
+                if state['gap_extend'] is None:
+                    score = needleman_wunsch_score(
+                        sequences[i], sequences[j], state['match'], state['mismatch'], state['gap'])
+                else:
+                    score = needleman_wunsch_affine_score(
+                        sequences[i], sequences[j], state['match'], state['mismatch'], state['gap'], state['gap_extend'])
+                results.append((i, j, score, None))
+            continue
+
+        for start in range(0, len(group), batch_size):
+            batch = group[start:start + batch_size]
+            scores = needleman_wunsch_scores(
+                sequences[i], [sequences[j] for j in batch],
+                state['match'], state['mismatch'], state['gap'], state['gap_extend'],
+            )
+            results.extend((i, j, score, None) for j, score in zip(batch, scores))
+
+    return results
+
+
+def balanced_chunks(pairs, costs, n_chunks):
+    """
+    pairs (list): items to distribute
+    costs (list): estimated cost of every item
+    n_chunks (int): number of chunks
+
+    Returns at most n_chunks lists of items with roughly equal total cost
+    (largest items first, each one to the currently lightest chunk)
+    """
+    heap = [(0, k) for k in range(min(n_chunks, len(pairs)))]
+    chunks = [[] for _ in heap]
+    for cost, pair in sorted(zip(costs, pairs), key=lambda item: -item[0]):
+        load, k = heapq.heappop(heap)
+        chunks[k].append(pair)
+        heapq.heappush(heap, (load + cost, k))
+
+    return chunks
+
+
+def create_distance_matrix(
+    sequences,
+    match=1,
+    mismatch=1,
+    gap=1,
+    gap_extend=None,
+    workers=1,
+    return_alignments=False,
+    cache=None,
+    band=None,
+    out=None,
+):
     """
     sequences (list): list of sequences
     match (int): score for matching characters
     mismatch (int): penalty for mismatching characters
     gap (int): penalty for gaps
+    workers (int): number of processes aligning the pairs
+    return_alignments (bool): whether to also return the aligned sequence pairs
+    cache (ScoreCache): cache of alignment scores, only the pairs missing from it are aligned
+                        (all pairs are aligned if return_alignments is set)
+    band (int | str): half-width of the band of diagonals or 'auto' for the banded alignment
+                      of the pairs, None for the full alignment (see 'band_limits')
+    out (CondensedMatrix): matrix the distances are written to as the pairs are aligned,
+                           a dense matrix is allocated if None
 
-    Returns pairwise distance matrix
+    Returns pairwise distance matrix, out if given (and a dict of aligned pairs if
+    return_alignments is set)
 
     """
     n = len(sequences)
-    dist_matrix = np.zeros((n, n))
-
+    dist_matrix = np.zeros((n, n)) if out is None else out
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.float64)
     align_seqs = {}
 
-    for i, j in combinations(range(n), 2):
-        if gap_extend is None:
-            align_seq1, align_seq2, _, score = needleman_wunsch(sequences[i][1], sequences[j][1], match, mismatch, gap)
+    def store(results):
+        if not results:
+            return
+        i, j, score = (np.array(column) for column in zip(*((i, j, score) for i, j, score, _ in results)))
+        dist = 1 - score / np.maximum(lengths[i], lengths[j])
+        if out is None:
+            dist_matrix[i, j], dist_matrix[j, i] = dist, dist
         else:
-            align_seq1, align_seq2, _, score = needleman_wunsch_affine(sequences[i][1], sequences[j][1], match, mismatch, gap, gap_extend)
-        
-        align_seqs[(i, j)] = (align_seq1, align_seq2)
-        align_seqs[(j, i)] = (align_seq2, align_seq1)
+            out.data[out.offsets[i] + j] = dist
+
+    pairs = list(combinations(range(n), 2))
+    params = (sequences, match, mismatch, gap, gap_extend, return_alignments, band)
+    # scores alone are computed in batches, alignments and banded alignments pair by pair
+    run = _align_pairs if return_alignments or band is not None else _score_pairs
+
+    if cache is not None:
+        scoring = ('nw', float(match), float(mismatch), float(gap), None if gap_extend is None else float(gap_extend))
+        if band is not None:
+            scoring += ('band', band)
+        keys = {(i, j): cache.key(sequences[i], sequences[j], scoring) for i, j in pairs}
+        if not return_alignments:
+            cached = cache.get_many(keys.values())
+            found = [(i, j, cached[key], None) for (i, j), key in keys.items() if key in cached]
+            store(found)
+            found = {(i, j) for i, j, _, _ in found}
+            pairs = [pair for pair in pairs if pair not in found]
 
-        dist = 1 - (score / max(len(sequences[i]), len(sequences[j])))
-        dist_matrix[i][j], dist_matrix[j][i] = dist, dist
+    # batched scoring keeps the pairs of a sequence together
+    groups = {}
+    for i, j in pairs:
+        groups.setdefault(i if run is _score_pairs else (i, j), []).append((i, j))
+    groups = list(groups.values())
 
-    return dist_matrix, align_seqs
+    computed = []
+
+    def finish(results):
+        # distances are stored chunk by chunk, only the alignments and the new cache entries are kept
+        store(results)
+        if cache is not None:
+            computed.extend((keys[(i, j)], score) for i, j, score, _ in results)
+        if return_alignments:
+            for i, j, _, alignment in results:
+                align_seqs[(i, j)] = alignment
+                align_seqs[(j, i)] = alignment[::-1]
+        progress.update(len(results))
+
+    progress = metrics.Progress(len(pairs), 'Distances')
+    metrics.count('pairs', len(pairs))
+    if workers > 1 and len(pairs) > 1:
+        costs = [sum(len(sequences[i]) * len(sequences[j]) for i, j in group) for group in groups]
+        chunks = [[pair for group in chunk for pair in group] for chunk in balanced_chunks(groups, costs, workers * 4)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=params) as pool:
+            # the counters of the workers are sent back with their results
+            for chunk, deltas in pool.map(partial(metrics.collect, run), chunks):
+                metrics.merge(deltas)
+                finish(chunk)
+    else:
+        _init_worker(*params)
+        for group in groups:
+            finish(run(group))
+        _worker_state.clear()
+
+    if cache is not None:
+        cache.put_many(computed)
+
+    if return_alignments:
+        return dist_matrix, align_seqs
+    return dist_matrix
 
 
 class UPGMA_Node:
-    def __init__(self, id, children=None, height=0):
+    """
+    Node of a guide tree: leaves keep the index of their sequence in 'id',
+    internal nodes have id None and keep their subtrees in 'children'
+    """
+    __slots__ = ('id', 'children', 'height', 'size', 'branch_lengths')
+
+    def __init__(self, id=None, children=None, height=0, branch_lengths=None):
         self.id = id
         self.children = children if children else []
         self.height = height
         self.size = 1 if not children else sum(child.size for child in children)
+        self.branch_lengths = (
+            branch_lengths if branch_lengths is not None
+            else [height - child.height for child in self.children]
+        )
+
 
+def postorder(root: UPGMA_Node):
+    """
+    root (UPGMA_Node): root of a tree
+
+    Yields the nodes of the tree in post-order (children left to right, then the parent).
+    The walk keeps an explicit stack instead of recursing, so the depth of the tree is
+    not limited by the recursion limit
+    """
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded or not node.children:
+            yield node
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.children))
+
+
+def leaves(root: UPGMA_Node) -> list:
+    """
+    root (UPGMA_Node): root of a tree
+
+    Returns the ids of the leaves from left to right
+    """
+    return [node.id for node in postorder(root) if not node.children]
+
+
+def sequence_weights(root: UPGMA_Node, counts=None) -> np.ndarray:
+    """
+    root (UPGMA_Node): root of a guide tree
+    counts (np.ndarray): number of sequences every leaf stands for (see 'dedup'), 1 if None
+
+    ClustalW weights: the length of every branch is shared equally by the sequences below it,
+    and a sequence gets the sum of its shares along the path from the root, so groups of
+    close relatives share their weight. A leaf standing for several sequences gets the sum
+    of their weights. The tree is walked once from the root (the sizes of the subtrees are
+    summed first if counts are given), the weights are scaled to a mean of 1 per sequence,
+    and a tree without branch lengths gives every sequence the weight 1
+
+    Returns the weights as an array indexed by leaf id
+    """
+    ids = leaves(root)
+    if counts is None:
+        counts = np.ones(max(ids) + 1)
+        sizes = None
+    else:
+        counts = np.asarray(counts, dtype=np.float64)
+        sizes = {}
+        for node in postorder(root):
+            sizes[id(node)] = sum(sizes[id(child)] for child in node.children) if node.children else counts[node.id]
+
+    weights = np.zeros(len(counts))
+    stack = [(root, 0.0)]
+    while stack:
+        node, share = stack.pop()
+        if not node.children:
+            weights[node.id] = share * counts[node.id]
+        for child, length in zip(node.children, node.branch_lengths):
+            size = child.size if sizes is None else sizes[id(child)]
+            stack.append((child, share + max(length, 0.0) / size))
+
+    used = weights[ids]
+    if not (used > 0).any():
+        return counts.copy()
+    # leaves without any branch length on their path would drop out of the profile counts
+    weights[ids] = np.where(used > 0, used, used[used > 0].min())
+    return weights * counts[ids].sum() / weights[ids].sum()
+
+
+def _initial_minima(distances: CondensedMatrix):
+    """
+    Returns the minimum of every row and the column attaining it, ties go to the smallest
+    column. The upper triangle is read once, segment by segment: a segment holds the
+    entries of its row to the right of the diagonal and those of its columns from above
+    """
+    n = len(distances)
+    row_min = np.full(n, np.inf)
+    row_arg = np.zeros(n, dtype=np.int64)
+    for i in range(n - 1):
+        segment = distances.segment(i).astype(np.float64)
+        k = int(segment.argmin())
+        if segment[k] < row_min[i]:
+            row_min[i], row_arg[i] = segment[k], i + 1 + k
+        closer = segment < row_min[i + 1:]
+        row_min[i + 1:][closer] = segment[closer]
+        row_arg[i + 1:][closer] = i
+
+    return row_min, row_arg
+
+
+def _row_minima(distances: CondensedMatrix, rows, order, active):
+    """
+    Returns the minimum of every given row over the active columns and the column
+    attaining it, ties go to the column of the oldest cluster (smallest order)
+    """
+    last = np.iinfo(np.int64).max
+    minima = np.empty(len(rows))
+    columns = np.empty(len(rows), dtype=np.int64)
+    for k, r in enumerate(rows):
+        row = distances.row(r)
+        row[~active] = np.inf
+        row[r] = np.inf
+        minima[k] = row.min()
+        columns[k] = np.where(row == minima[k], order, last).argmin()
+
+    return minima, columns
 
-def upgma(dist_matrix: np.ndarray):
+
+def upgma(dist_matrix: np.ndarray | CondensedMatrix):
+    """
+    dist_matrix (np.ndarray | CondensedMatrix): symmetric pairwise distance matrix, a condensed
+                                               matrix is overwritten, a dense one is copied
+
+    Builds the UPGMA tree in the condensed matrix: the merged cluster takes the slot of its
+    first member and the slot of the second one is switched off. Row minima are cached, so
+    a step only reads the rows of the merged pair and the rows whose nearest cluster has just
+    been merged. Ties are broken in the order the clusters were created, which gives the same
+    trees as merging in a matrix rebuilt at every step with the same entries. With float32
+    entries the distances and the averages of merged clusters are rounded to float32, which
+    can create or break ties, so the tree may differ from the one of float64 entries
+
+    Returns the root node of the tree
+    """
     n = len(dist_matrix)
     clusters = [UPGMA_Node(i) for i in range(n)]
-    distances = dist_matrix.copy()
-    np.fill_diagonal(distances, np.inf)
+    if isinstance(dist_matrix, CondensedMatrix):
+        distances = dist_matrix
+    else:
+        distances = CondensedMatrix.from_dense(dist_matrix, dtype=np.float64)
 
-    while len(clusters) > 1:
-        i, j = np.unravel_index(np.argmin(distances), distances.shape)
-        min_dist = distances[i][j] / 2
+    active = np.ones(n, dtype=bool)
+    order = np.arange(n, dtype=np.int64)
+    row_min, row_arg = _initial_minima(distances)
+    last = np.iinfo(np.int64).max
+
+    for step in range(n - 1):
+        min_dist = row_min[active].min()
+        i = np.where(active & (row_min == min_dist), order, last).argmin()
+        j = row_arg[i]
 
         new_cluster = UPGMA_Node(
-            id=f"({clusters[i].id},{clusters[j].id})",
             children=[(clusters[i]), (clusters[j])],
-            height=min_dist
+            height=distances[i, j] / 2
         )
-        new_distances = np.zeros((distances.shape[0] + 1, distances.shape[1] + 1))
-        new_distances[:-1, :-1] = distances
-        new_distances[-1, -1] = np.inf
-
-        for k in range(len(distances)):
-            if k != i and k != j:
-                d = (distances[i][k] * clusters[i].size +
-                     distances[j][k] * clusters[j].size) / (clusters[i].size + clusters[j].size)
-                new_distances[k][-1] = d
-                new_distances[-1][k] = d
-
-        mask = np.ones(len(new_distances), dtype=bool)
-        mask[[i, j]] = False
-        distances = new_distances[mask][:, mask]
-
-        i, j = sorted([i, j])
-        del clusters[j]
-        del clusters[i]
-        clusters.append(new_cluster)
-
-    return clusters[0]
+
+        merged = (distances.row(i) * clusters[i].size +
+                  distances.row(j) * clusters[j].size) / (clusters[i].size + clusters[j].size)
+        active[j] = False
+        merged[~active] = np.inf
+        merged[i] = np.inf
+        distances.set_row(i, merged)
+
+        clusters[i], clusters[j] = new_cluster, None
+        order[i] = n + step
+
+        stale = active & ((row_arg == i) | (row_arg == j))
+        stale[i] = True
+        closer = active & ~stale & (merged < row_min)
+        row_min[closer], row_arg[closer] = merged[closer], i
+
+        stale_rows = np.flatnonzero(stale)
+        row_min[stale_rows], row_arg[stale_rows] = _row_minima(distances, stale_rows, order, active)
+
+    return clusters[int(np.flatnonzero(active)[0])]